@@ -0,0 +1,203 @@
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from instrumentation import report
+from storage import parse_timestamps, local_time
+
+# Desc: Reads an export straight from the export.zip written by the Health app, without extracting it to disk: export.xml is streamed
+#       out of the archive and the electrocardiograms (one CSV per recording) and workout routes (one GPX file per route) are parsed
+#       in batches by a pool of worker processes, each opening the archive itself
+
+# name of the records file within the archive (apple_health_export/export.xml)
+EXPORT_MEMBER = "export.xml"
+# files parsed per worker task, the archives hold thousands of small files
+BATCH_SIZE = 64
+# namespace of the GPX 1.1 elements
+GPX_NAMESPACE = "{http://www.topografix.com/GPX/1/1}"
+# local start time of the workout in the name of a route file, e.g. route_2023-03-01_3.05pm.gpx
+ROUTE_NAME = re.compile(r"route_(\d{4}-\d{2}-\d{2})_(\d{1,2}\.\d{2}[ap]m)")
+
+
+# Desc: Whether an export is an export.zip (anything else is read as an export.xml)
+# Input: Path of the export
+# Output: True for a zip archive
+def is_archive(exportFile):
+    return zipfile.is_zipfile(exportFile)
+
+
+# Desc: Opens the export.xml of an export, streamed out of the archive for an export.zip
+# Input: Path of an export.xml or export.zip
+# Output: Context manager yielding a binary file object (see iter_records() in main.py)
+@contextmanager
+def open_export(exportFile):
+    if not is_archive(exportFile):
+        with open(exportFile, "rb") as file:
+            yield file
+        return
+    with zipfile.ZipFile(exportFile) as archive:
+        # export_cda.xml (clinical documents) sits next to export.xml, only the file named exactly export.xml holds the records
+        names = [name for name in archive.namelist() if os.path.basename(name) == EXPORT_MEMBER]
+        if not names:
+            raise ValueError(f"No {EXPORT_MEMBER} in {exportFile}")
+        with archive.open(min(names, key=len)) as file:
+            yield file
+
+
+# Desc: Lists the files of a folder of the archive, e.g. apple_health_export/electrocardiograms/*.csv
+# Input: Path of the export.zip, folder name and file extension
+# Output: Sorted list of member names
+def archive_members(exportFile, folder, extension):
+    with zipfile.ZipFile(exportFile) as archive:
+        return sorted(name for name in archive.namelist() if f"{folder}/" in name and name.lower().endswith(extension))
+
+
+# Desc: Parses an electrocardiogram export: a header of "key,value" lines (recorded date, classification, sample rate, lead, unit, ...)
+#       followed by one voltage per line
+# Input: Member name and the decoded content of the CSV
+# Output: Dictionary with the header fields and the float32 voltages
+def parse_ecg(name, text):
+    lines = text.splitlines()
+    header = {}
+    index = 0
+    for index, line in enumerate(lines):
+        key, _, value = line.partition(",")
+        # the voltages start at the first line that is a number
+        try:
+            float(key)
+            break
+        except ValueError:
+            if key.strip():
+                header[key.strip()] = value.strip().strip('"')
+    else:
+        index = len(lines)
+
+    return {
+        "file": os.path.basename(name),
+        "recordedDate": header.get("Recorded Date"),
+        "classification": header.get("Classification"),
+        "symptoms": header.get("Symptoms") or None,
+        "softwareVersion": header.get("Software Version"),
+        "device": header.get("Device"),
+        "sampleRate": float(header.get("Sample Rate", "nan").split()[0]),
+        "lead": header.get("Lead"),
+        "unit": header.get("Unit"),
+        "voltage": np.array(" ".join(lines[index:]).split(), dtype=np.float32),
+    }
+
+
+# Desc: Parses a workout route, every track point has a time, position and elevation and the speed, course and accuracies recorded by
+#       the Watch or iPhone
+# Input: Member name and the content of the GPX file
+# Output: Dictionary of column -> list of values, one entry per track point
+def parse_route(name, data):
+    route = os.path.splitext(os.path.basename(name))[0]
+    columns = {column: [] for column in ["route", "time", "latitude", "longitude", "elevation", "speed", "course", "horizontalAccuracy", "verticalAccuracy"]}
+    children = {GPX_NAMESPACE + tag: column for tag, column in {"ele": "elevation", "time": "time", "speed": "speed", "course": "course", "hAcc": "horizontalAccuracy", "vAcc": "verticalAccuracy"}.items()}
+    # route files are small, parsing the whole tree at once is faster than streaming it
+    for trackPoint in ET.fromstring(data).iter(GPX_NAMESPACE + "trkpt"):
+        point = {"route": route, "latitude": trackPoint.get("lat"), "longitude": trackPoint.get("lon")}
+        # ele and time are children of trkpt, speed, course and the accuracies are in its extensions
+        for child in trackPoint.iter():
+            column = children.get(child.tag)
+            if column is not None:
+                point[column] = child.text
+        for column, values in columns.items():
+            values.append(point.get(column))
+    return columns
+
+
+# Desc: Worker that parses a batch of electrocardiograms
+# Input: Tuple of (export.zip path, list of member names)
+# Output: Typed DataFrame of the recordings (see ecg_frame()) and the stage record of the batch (see instrumentation.py)
+def ecg_batch(shard):
+    exportFile, names = shard
+    with report.stage("ecg_batch") as record, zipfile.ZipFile(exportFile) as archive:
+        recordings = [parse_ecg(name, archive.read(name).decode("utf-8-sig")) for name in names]
+        # localized exports translate the header keys, a recording without a recorded date in the export.xml format is skipped
+        recordings = [recording for recording in recordings if recording["recordedDate"] is not None and len(recording["recordedDate"]) == 25]
+        report.count(recordsScanned=len(names), recordsSkipped=len(names) - len(recordings))
+        df = ecg_frame(recordings)
+    return df, record
+
+
+# Desc: Worker that parses a batch of workout routes
+# Input: Tuple of (export.zip path, list of member names)
+# Output: Typed DataFrame of the track points (see route_frame()) and the stage record of the batch (see instrumentation.py)
+def route_batch(shard):
+    exportFile, names = shard
+    with report.stage("route_batch") as record, zipfile.ZipFile(exportFile) as archive:
+        columns = None
+        for name in names:
+            routeColumns = parse_route(name, archive.read(name))
+            if columns is None:
+                columns = routeColumns
+            else:
+                for column, values in routeColumns.items():
+                    columns[column] += values
+        report.count(recordsScanned=len(names))
+        df = route_frame(columns)
+    return df, record
+
+
+# Desc: Builds the typed DataFrame of electrocardiograms
+# Input: List of parsed recordings (see parse_ecg())
+# Output: DataFrame with one row per recording: date, time (UTC) and utcOffset of the recording, categorical classification, softwareVersion,
+#         device, lead and unit, symptoms, the sampleRate (Hz), the number of samples and the voltages as a float32 list column
+def ecg_frame(recordings):
+    recordedDates = [recording["recordedDate"] for recording in recordings]
+    epochSeconds, utcOffsets = parse_timestamps(recordedDates)
+    df = pd.DataFrame({
+        "date": pd.to_datetime(pd.Series([recordedDate[0:10] for recordedDate in recordedDates], dtype="str"), format="%Y-%m-%d"),
+        "time": pd.to_datetime(epochSeconds, unit="s", utc=True),
+        "utcOffset": utcOffsets,
+    })
+    for column in ["classification", "softwareVersion", "device", "lead", "unit"]:
+        df[column] = pd.Categorical([recording[column] for recording in recordings])
+    # mostly empty free text, a categorical without any category would be read back as float
+    df["symptoms"] = pd.Series([recording["symptoms"] for recording in recordings], dtype="str")
+    df["sampleRate"] = np.array([recording["sampleRate"] for recording in recordings], dtype=np.float64)
+    df["samples"] = np.array([len(recording["voltage"]) for recording in recordings], dtype=np.int64)
+    df["voltage"] = pd.Series([recording["voltage"] for recording in recordings], dtype="object")
+    df["file"] = pd.Series([recording["file"] for recording in recordings], dtype="str")
+    return df
+
+
+# Desc: Offset of the local time of a workout route, the GPX times are UTC but the file name holds the local start time of the workout
+# Input: Route (file name without extension) and the UTC time of its first track point
+# Output: Offset in minutes (rounded to 15 minutes), 0 if the file name doesn't hold the start time
+def route_offset(route, firstTime):
+    match = ROUTE_NAME.search(route)
+    if match is None:
+        return 0
+    start = datetime.strptime(" ".join(match.groups()), "%Y-%m-%d %I.%M%p")
+    return round((start - firstTime.tz_localize(None).to_pydatetime()).total_seconds() / 900) * 15
+
+
+# Desc: Builds the typed DataFrame of workout routes
+# Input: Dictionary of column -> list of values (see parse_route()), None for no routes
+# Output: DataFrame with one row per track point: local date, time (UTC) and utcOffset (see route_offset()), categorical route (file name)
+#         and float64 latitude, longitude, elevation (m), speed (m/s), course (degrees) and horizontal/vertical accuracy (m)
+def route_frame(columns):
+    if columns is None:
+        columns = parse_route("", b"<gpx/>")
+    times = pd.to_datetime(pd.Series(columns["time"], dtype="str"), utc=True, format="ISO8601")
+    df = pd.DataFrame({"time": times, "route": pd.Categorical(columns["route"])})
+    offsets = {route: route_offset(route, firstTime) for route, firstTime in df.groupby("route", observed=True)["time"].min().items()}
+    df.insert(1, "utcOffset", df["route"].map(offsets).astype(np.int16))
+    # same as the other data types, the date is the local date the track point was recorded on
+    df.insert(0, "date", local_time(df, "time").dt.floor("D"))
+    for column in ["latitude", "longitude", "elevation", "speed", "course", "horizontalAccuracy", "verticalAccuracy"]:
+        df[column] = pd.to_numeric(pd.Series(columns[column], dtype="object"), errors="coerce").astype(np.float64)
+    return df
+
+
+# output file name, folder in the archive, file extension and batch worker of every kind of file attached to the records
+ATTACHMENTS = [
+    ("ecg_data", "electrocardiograms", ".csv", ecg_batch),
+    ("workout_route_data", "workout-routes", ".gpx", route_batch),
+]
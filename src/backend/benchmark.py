@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import pandas as pd
+from generate_export import generate_export, generate_archive
+from instrumentation import peak_rss
+from main import static_data, data_extract, attachments_extract, three_days_data, online_statistics, build_catalog, CONTEXT_METRICS
+from archive import archive_members, ATTACHMENTS
+from contexts import join_contexts, read_contexts
+from query_store import QueryStore
+from rollups import build_rollups
+from statistical_tests import StatisticalTest
+from storage import parquet_path, read_data_type, write_csv
+
+# Desc: Benchmark suite for the pipeline, every stage runs on synthetic exports (see generate_export.py) of increasing size and
+#       reports its throughput (records/sec) and peak RSS. Each stage runs in a fresh interpreter so peak RSS is per stage.
+
+YEAR = "2023"
+# the online statistics, the query store and the aggregates only cover the types with numeric values
+QUANTITY_DATA = [object for object in static_data(YEAR) if object["kind"] == "quantity"]
+THREE_DAYS_TYPES = ["heart_rate_data", "steps_data", "spo2_data", "gait_length_data"]
+# hourly aggregates written by the aggregate stage and read by the correlations stage (same file as main.py)
+HOURLY_AGGREGATES_FILE = "../data/descriptive_statistics/hourly_aggregates.csv"
+
+
+def stage_build_catalog(exportFile, records, workers):
+    build_catalog(exportFile, workers)
+    return records
+
+
+def stage_data_extract(exportFile, records, workers):
+    data_extract(exportFile, static_data(YEAR))
+    return records
+
+
+def stage_data_extract_parallel(exportFile, records, workers):
+    data_extract(exportFile, static_data(YEAR), workers)
+    return records
+
+
+def stage_online_statistics(exportFile, records, workers):
+    online_statistics(exportFile, QUANTITY_DATA, "hour", workers)
+    return records
+
+
+def stage_attachments(exportFile, records, workers):
+    # the export.zip is generated next to export.xml (see benchmark())
+    archiveFile = os.path.join(os.path.dirname(exportFile), "export.zip")
+    attachments_extract([archiveFile], YEAR, workers)
+    return sum(len(archive_members(archiveFile, folder, extension)) for outputFileName, folder, extension, worker in ATTACHMENTS)
+
+
+def stage_load_query_store(exportFile, records, workers):
+    loaded = 0
+    with QueryStore() as store:
+        for object in QUANTITY_DATA:
+            loaded += store.load_data_type(object["dataTypeString"], read_data_type(object["outputFileName"], YEAR), object["unit"])
+    return loaded
+
+
+def stage_rollups(exportFile, records, workers):
+    for object in QUANTITY_DATA:
+        build_rollups(object)
+    return sum(len(read_data_type(object["outputFileName"], YEAR, columns=["utcOffset"])) for object in QUANTITY_DATA)
+
+
+def stage_three_days_data(exportFile, records, workers):
+    firstThreeDates = three_days_data(THREE_DAYS_TYPES[0], YEAR)
+    for outputFileName in THREE_DAYS_TYPES[1:]:
+        three_days_data(outputFileName, YEAR, firstThreeDates)
+    return sum(len(read_data_type(outputFileName, YEAR, columns=["date"])) for outputFileName in THREE_DAYS_TYPES)
+
+
+def stage_descriptive_statistics(exportFile, records, workers):
+    statisticalTestInstance = StatisticalTest(
+        heartRateFile=parquet_path("three_days_heart_rate_data", YEAR),
+        stepsFile=parquet_path("three_days_steps_data", YEAR),
+        gaitFile=parquet_path("three_days_gait_length_data", YEAR),
+        spo2File=parquet_path("three_days_spo2_data", YEAR),
+    )
+    statisticalTestInstance.descriptive_statistics()
+    return sum(len(read_data_type("three_days_" + outputFileName, YEAR, columns=["date"])) for outputFileName in THREE_DAYS_TYPES)
+
+
+def stage_aggregate(exportFile, records, workers):
+    with QueryStore() as store:
+        df = store.query([object["dataTypeString"] for object in QUANTITY_DATA])
+    write_csv(StatisticalTest().aggregate(df, bucket="hour"), HOURLY_AGGREGATES_FILE)
+    return len(df)
+
+
+def stage_correlations(exportFile, records, workers):
+    aggregates = pd.read_csv(HOURLY_AGGREGATES_FILE, parse_dates=["bucket"])
+    StatisticalTest().correlations(aggregates, lags=range(-3, 4), workers=workers)
+    return len(aggregates)
+
+
+def stage_context_statistics(exportFile, records, workers):
+    with QueryStore() as store:
+        df = store.query(CONTEXT_METRICS)
+    StatisticalTest().context_statistics(join_contexts(df, "start", read_contexts(YEAR)))
+    return len(df)
+
+
+# stages in pipeline order, later stages read the files written by the earlier ones
+STAGES = {
+    "build_catalog": stage_build_catalog,
+    "data_extract": stage_data_extract,
+    "data_extract_parallel": stage_data_extract_parallel,
+    "online_statistics": stage_online_statistics,
+    "attachments": stage_attachments,
+    "load_query_store": stage_load_query_store,
+    "rollups": stage_rollups,
+    "three_days_data": stage_three_days_data,
+    "descriptive_statistics": stage_descriptive_statistics,
+    "aggregate": stage_aggregate,
+    "correlations": stage_correlations,
+    "context_statistics": stage_context_statistics,
+}
+
+
+# Desc: Runs a single stage (inside a fresh interpreter, see benchmark())
+# Input: Stage name, export.xml path, number of records in the export and the number of workers of the parallel stages
+# Output: Dictionary with the wall time, CPU time, records processed, the peak RSS of the stage and the RSS after the imports
+def run_stage(stage, exportFile, records, workers):
+    baselineRss = peak_rss()
+    startWall = time.perf_counter()
+    startCpu = time.process_time()
+    processed = STAGES[stage](exportFile, records, workers)
+    seconds = time.perf_counter() - startWall
+    return {
+        "stage": stage,
+        "seconds": seconds,
+        "cpuSeconds": time.process_time() - startCpu,
+        "records": processed,
+        "recordsPerSecond": processed / seconds if seconds else None,
+        "peakRssBytes": peak_rss(),
+        "baselineRssBytes": baselineRss,
+    }
+
+
+# Desc: Benchmarks every stage on synthetic exports of each size
+# Input: List of export sizes (records), working directory, number of workers for the parallel stages, stages to run and random seed
+# Output: List of result dictionaries (one per size and stage)
+def benchmark(sizes, workDir, workers=os.cpu_count(), stages=list(STAGES), seed=0):
+    results = []
+    for size in sizes:
+        # the pipeline writes to ../data relative to the working directory, so every size gets its own backend directory
+        backendDir = os.path.join(os.path.abspath(workDir), f"records_{size}", "backend")
+        os.makedirs(backendDir, exist_ok=True)
+        exportFile = os.path.join(os.path.dirname(backendDir), "export.xml")
+        if not os.path.exists(exportFile):
+            generate_export(exportFile, size, seed)
+        # about an electrocardiogram a week and a route every other day for the year covered by a 1M record export
+        archiveFile = os.path.join(os.path.dirname(backendDir), "export.zip")
+        if "attachments" in stages and not os.path.exists(archiveFile):
+            generate_archive(archiveFile, exportFile, max(1, size // 20000), max(1, size // 5000), seed)
+
+        for stage in stages:
+            # every stage runs in its own interpreter so ru_maxrss only reflects that stage
+            command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage, exportFile, str(size), "--workers", str(workers)]
+            output = subprocess.run(command, cwd=backendDir, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.splitlines()[-1])
+            result["size"] = size
+            result["exportBytes"] = os.path.getsize(exportFile)
+            results.append(result)
+            print(f"{size:>10} {stage:<24} {result['seconds']:>9.2f}s {result['recordsPerSecond'] or 0:>12.0f} rec/s {result['peakRssBytes'] / 2**20:>9.1f} MiB", flush=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic Apple Health exports")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="export sizes in records (default: 10000 100000 1000000, up to 50000000)")
+    parser.add_argument("--work-dir", default="../benchmark", help="directory for the generated exports and pipeline outputs (default: ../benchmark)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes of the parallel stages (default: cpu count)")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="stages to run, in pipeline order (default: all)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the generated exports (default: 0)")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--run-stage", nargs=3, metavar=("STAGE", "EXPORT", "RECORDS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        # internal: run a single stage in this interpreter and print its result
+        stage, exportFile, records = args.run_stage
+        print(json.dumps(run_stage(stage, exportFile, int(records), args.workers)))
+        sys.exit(0)
+
+    results = benchmark(args.sizes, args.work_dir, args.workers, args.stages, args.seed)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+    print(pd.DataFrame(results)[["size", "stage", "seconds", "cpuSeconds", "records", "recordsPerSecond", "peakRssBytes", "baselineRssBytes"]].to_string(index=False))
@@ -0,0 +1,197 @@
+import math
+from array import array
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from data_types import COLUMN_ATTRIBUTES, source_name, device_name
+from storage import parse_timestamp_bytes, TIME_COLUMNS
+
+# Desc: Compact columnar buffers the extraction appends the records of a data type to, instead of a Python object per record:
+#       timestamps are kept as their 25 raw bytes, values as float64 and repeated strings (date, source, device, unit, category values)
+#       as int32 codes into a dictionary. The buffers are handed to numpy without copying (np.frombuffer) when the DataFrame is built
+
+# length of an export.xml timestamp, e.g. "2023-01-01 10:00:00 -0500"
+TIMESTAMP_WIDTH = 25
+
+
+class TimestampColumn:
+    # Desc: Growable buffer of fixed width timestamp bytes
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data) // TIMESTAMP_WIDTH
+
+    # Desc: Appends the timestamps of another buffer (e.g. of another shard)
+    def extend(self, other):
+        self.data += other.data
+
+    # Desc: Converts the timestamps in one vectorized pass
+    # Output: Tuple of (int64 array of epoch seconds (UTC), int16 array of the timezone offsets in minutes)
+    def epoch_seconds(self):
+        if len(self.data) % TIMESTAMP_WIDTH:
+            raise ValueError("Unexpected timestamp format, expected 'YYYY-MM-DD HH:MM:SS +HHMM'")
+        return parse_timestamp_bytes(np.frombuffer(self.data, dtype=np.uint8).reshape(-1, TIMESTAMP_WIDTH))
+
+
+class FloatColumn:
+    # Desc: Growable float64 buffer, values that aren't numbers are stored as nan
+    def __init__(self) -> None:
+        self.data = array("d")
+
+    def __len__(self):
+        return len(self.data)
+
+    def extend(self, other):
+        self.data.extend(other.data)
+
+    def values(self):
+        return np.frombuffer(self.data, dtype=np.float64)
+
+
+class CodedColumn:
+    # Desc: Dictionary encoded column of strings, each row holds the int32 code of its string (codes are assigned in order of appearance)
+    def __init__(self) -> None:
+        self.codes = array("i")
+        # string (or None for a missing attribute) -> code
+        self.dictionary = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    # Desc: Appends the rows of another column, its codes are translated to the codes of this column
+    def extend(self, other):
+        translation = np.array([self.dictionary.setdefault(value, len(self.dictionary)) for value in other.dictionary], dtype=np.int32)
+        if len(other):
+            self.codes.frombytes(translation[other.code_values()].tobytes())
+
+    def code_values(self):
+        return np.frombuffer(self.codes, dtype=np.int32)
+
+    # Desc: Builds a categorical, optionally mapping every distinct string first (e.g. the device attribute to the device name)
+    # Input: Function applied to every distinct string (None for missing attributes), a None result is a missing value
+    # Output: pandas Categorical with sorted categories (same as astype("category"))
+    def categorical(self, function=None):
+        mapped = [function(value) if function is not None else value for value in self.dictionary]
+        categories = sorted({value for value in mapped if value is not None})
+        positions = {category: index for index, category in enumerate(categories)}
+        translation = np.array([positions.get(value, -1) if value is not None else -1 for value in mapped] + [-1], dtype=np.int32)
+        return pd.Categorical.from_codes(translation[self.code_values()], categories=categories)
+
+
+# Desc: Empty column buffers of a data type
+# Input: Data type dictionary (see static_data() in main.py)
+# Output: Dictionary of column -> buffer, keyed by the raw column names (see COLUMN_ATTRIBUTES)
+def new_buffers(object):
+    buffers = {}
+    for column in object["columns"]:
+        if column in TIME_COLUMNS:
+            buffers[column] = TimestampColumn()
+        elif column == "value" and object["dtype"] == "float64":
+            buffers[column] = FloatColumn()
+        else:
+            buffers[column] = CodedColumn()
+    return buffers
+
+
+# Desc: Coded column holding the same value in every row, e.g. the index of the export a data type's records were read from
+# Input: Value and number of rows
+# Output: CodedColumn
+def constant_column(value, length):
+    column = CodedColumn()
+    column.dictionary[value] = 0
+    column.codes.frombytes(np.zeros(length, dtype=np.int32).tobytes())
+    return column
+
+
+# Desc: Generates the extraction function of a set of columns, the generated code appends the attribute of every column straight to
+#       its buffer without any per record dispatch, e.g. for ("date", "value", "time") with float values:
+#           def extract(get):
+#               creationDate = get("creationDate")
+#               codes_0(dictionary_0.setdefault(creationDate[0:10], len(dictionary_0)))
+#               try:
+#                   append_1(float(get("value")))
+#               except (TypeError, ValueError):
+#                   append_1(nan)
+#               extend_2(creationDate.encode())
+# Input: Tuple of columns (see COLUMN_ATTRIBUTES) and the dtype of the value column
+# Output: Function that binds the extraction function to the column buffers of a data type (see new_buffers()), the extraction
+#         function takes the get method of a Record's attributes
+@lru_cache(maxsize=None)
+def compile_extractor(columns, dtype):
+    lines = ["def bind(buffers):"]
+    body = []
+    # the creation date is shared by the date and time columns, so it is only looked up once
+    if "date" in columns or "time" in columns:
+        body += ['creationDate = get("creationDate")']
+
+    for index, column in enumerate(columns):
+        if column == "date":
+            attribute = "creationDate[0:10]"
+        elif column == "time":
+            attribute = "creationDate"
+        else:
+            attribute = f"get({COLUMN_ATTRIBUTES[column]!r})"
+
+        if column in TIME_COLUMNS:
+            lines += [f"    extend_{index} = buffers[{column!r}].data.extend"]
+            body += [f"extend_{index}({attribute}.encode())"]
+        elif column == "value" and dtype == "float64":
+            lines += [f"    append_{index} = buffers[{column!r}].data.append"]
+            body += ["try:", f"    append_{index}(float({attribute}))", "except (TypeError, ValueError):", f"    append_{index}(nan)"]
+        else:
+            lines += [f"    codes_{index} = buffers[{column!r}].codes.append", f"    dictionary_{index} = buffers[{column!r}].dictionary"]
+            body += [f"codes_{index}(dictionary_{index}.setdefault({attribute}, len(dictionary_{index})))"]
+
+    lines += ["    def extract(get):"] + ["        " + line for line in body] + ["    return extract"]
+    namespace = {"nan": math.nan}
+    exec(compile("\n".join(lines), f"<extractor {', '.join(columns)}>", "exec"), namespace)
+    return namespace["bind"]
+
+
+# Desc: Binds the extraction function of a data type to its column buffers
+# Input: Data type dictionary and its column buffers (see new_buffers())
+# Output: Function called with the get method of every matching Record's attributes
+def bind_extractor(object, buffers):
+    return compile_extractor(object["columns"], object["dtype"])(buffers)
+
+
+# Desc: Builds the typed DataFrame of a data type from its column buffers, rows are grouped per creation date in order of the first
+#       observation of each date
+# Input: Data type dictionary and its column buffers
+# Output: DataFrame with datetime64 date, UTC datetime64 timestamps (plus the int16 utcOffset of the first timestamp column),
+#         float64 (or categorical) values, totalTime (seconds between startTime and endTime) and categorical source/device/unit
+def typed_frame(object, buffers):
+    # date codes are assigned in order of appearance, so a stable sort on them groups the rows per date
+    dateCodes = buffers["date"].code_values()
+    order = None
+    if len(dateCodes) and (np.diff(dateCodes) < 0).any():
+        order = np.argsort(dateCodes, kind="stable")
+
+    def rows(values):
+        return values if order is None else values[order]
+
+    df = pd.DataFrame()
+    firstUtcOffsets = None
+    for column, buffer in buffers.items():
+        if column == "date":
+            dates = pd.to_datetime(pd.Series(list(buffer.dictionary), dtype="str"), format="%Y-%m-%d")
+            df["date"] = dates.to_numpy()[rows(dateCodes)]
+        elif column in TIME_COLUMNS:
+            epochSeconds, utcOffsets = buffer.epoch_seconds()
+            df[column] = pd.to_datetime(rows(epochSeconds), unit="s", utc=True)
+            if firstUtcOffsets is None:
+                firstUtcOffsets = rows(utcOffsets)
+        elif isinstance(buffer, FloatColumn):
+            df[object["valueColumn"]] = rows(buffer.values())
+        else:
+            function = {"source": source_name, "device": device_name, "unit": lambda unit: unit or ""}.get(column)
+            categorical = buffer.categorical(function)
+            df[object["valueColumn"] if column == "value" else column] = categorical if order is None else categorical[order]
+    if firstUtcOffsets is not None:
+        df["utcOffset"] = firstUtcOffsets
+
+    # duration of the measurement, computed from the full timestamps so samples crossing midnight are handled
+    if "startTime" in df.columns and "endTime" in df.columns:
+        df["totalTime"] = (df["endTime"] - df["startTime"]).dt.total_seconds()
+    return df
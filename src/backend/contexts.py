@@ -0,0 +1,95 @@
+import os
+import numpy as np
+import pandas as pd
+from data_types import DATA_TYPES, WORKOUT_TYPE
+from query_store import epoch_seconds
+from storage import parquet_path, read_data_type
+
+# Desc: Context of point samples (e.g. heart rate, HRV, SpO2): the workout, mindful session or sleep stage covering every sample, or
+#       "rest" if none does. Samples are matched to the periods with a sorted interval join (searchsorted over the whole year) instead
+#       of comparing every sample to every period
+
+# data types whose periods are contexts, from highest to lowest priority: a sample taken during a workout in bed is a workout sample
+# (context name, dataTypeString, prefix stripped from the values, e.g. HKWorkoutActivityTypeRunning -> Running)
+CONTEXTS = [
+    ("workout", WORKOUT_TYPE, "HKWorkoutActivityType"),
+    ("mindful", "HKCategoryTypeIdentifierMindfulSession", "HKCategoryValue"),
+    ("sleep", "HKCategoryTypeIdentifierSleepAnalysis", "HKCategoryValueSleepAnalysis"),
+]
+# in bed periods enclose the sleep stages, so they come after every other context and a sample within a stage gets the stage
+IN_BED = "InBed"
+# context of the samples no period covers
+REST = "rest"
+
+
+# Desc: Interval join of points against periods: the index of the period covering every point, periods are half open [start, end)
+#       Among the periods started before a point, the last one started (the shortest one on ties) is taken if it covers the point,
+#       otherwise the one reaching the furthest (which covers the point if any of them does). This is exact for periods that don't
+#       overlap and for periods nested in one enclosing period (e.g. sleep stages within an in bed period)
+# Input: int64 arrays of the point times and of the period starts and ends (same unit)
+# Output: int64 array with the index of the matching period for every point, -1 for points no period covers
+def interval_join(times, starts, ends):
+    # empty periods can't cover any point
+    nonEmpty = np.flatnonzero(ends > starts)
+    if len(nonEmpty) == 0:
+        return np.full(len(times), -1, dtype=np.int64)
+    # periods starting at the same time are ordered longest first, so the innermost one is the last started
+    order = nonEmpty[np.lexsort((starts[nonEmpty] - ends[nonEmpty], starts[nonEmpty]))]
+    sortedStarts = starts[order]
+    sortedEnds = ends[order]
+    # furthest end among the periods started so far, and the (last) period reaching it
+    reach = np.maximum.accumulate(sortedEnds)
+    reachIndex = np.maximum.accumulate(np.where(sortedEnds == reach, np.arange(len(order)), 0))
+
+    # last period started at or before every point
+    candidates = np.searchsorted(sortedStarts, times, side="right") - 1
+    started = candidates >= 0
+    candidates = np.maximum(candidates, 0)
+    matches = np.where(started & (times < sortedEnds[candidates]), candidates, np.where(started & (times < reach[candidates]), reachIndex[candidates], -1))
+    return np.where(matches >= 0, order[np.maximum(matches, 0)], -1)
+
+
+# Desc: Reads the periods of every context for a year
+# Input: Year (YYYY)
+# Output: DataFrame with start and end (epoch seconds), context, detail (e.g. the workout activity or sleep stage) and level (priority,
+#         lowest first) of every period
+def read_contexts(year):
+    registry = {dataType["dataTypeString"]: dataType for dataType in DATA_TYPES}
+    frames = []
+    for level, (context, dataTypeString, prefix) in enumerate(CONTEXTS):
+        dataType = registry[dataTypeString]
+        if not os.path.exists(parquet_path(dataType["outputFileName"], year)):
+            continue
+        df = read_data_type(dataType["outputFileName"], year, columns=["startTime", "endTime", dataType["valueColumn"]])
+        details = df[dataType["valueColumn"]].astype("object").fillna("").str.replace(prefix, "", regex=False)
+        frames.append(pd.DataFrame({
+            "start": epoch_seconds(df["startTime"]).to_numpy(dtype=np.int64),
+            "end": epoch_seconds(df["endTime"]).to_numpy(dtype=np.int64),
+            "context": context,
+            "detail": details.to_numpy(dtype="object"),
+            "level": np.where(details == IN_BED, len(CONTEXTS), level),
+        }))
+    if not frames:
+        return pd.DataFrame({"start": pd.Series(dtype=np.int64), "end": pd.Series(dtype=np.int64), "context": pd.Series(dtype="object"),
+                             "detail": pd.Series(dtype="object"), "level": pd.Series(dtype=np.int64)})
+    return pd.concat(frames, ignore_index=True)
+
+
+# Desc: Adds the context of every sample, each level of CONTEXTS is joined in order of priority and only to the samples that no
+#       higher priority period covers
+# Input: DataFrame of samples, the name of its UTC timestamp column (e.g. start for QueryStore.query() results) and the periods of
+#        every context (see read_contexts())
+# Output: DataFrame with the added categorical context (workout, mindful, sleep or rest) and detail columns
+def join_contexts(df, timeColumn, contexts):
+    times = epoch_seconds(df[timeColumn]).to_numpy(dtype=np.int64)
+    sampleContexts = np.full(len(times), REST, dtype="object")
+    sampleDetails = np.full(len(times), "", dtype="object")
+    pending = np.arange(len(times))
+    for level in np.unique(contexts["level"].to_numpy()):
+        periods = contexts[contexts["level"] == level]
+        matches = interval_join(times[pending], periods["start"].to_numpy(), periods["end"].to_numpy())
+        matched = matches >= 0
+        sampleContexts[pending[matched]] = periods["context"].to_numpy()[matches[matched]]
+        sampleDetails[pending[matched]] = periods["detail"].to_numpy()[matches[matched]]
+        pending = pending[~matched]
+    return df.assign(context=pd.Categorical(sampleContexts), detail=pd.Categorical(sampleDetails))
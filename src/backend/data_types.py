@@ -0,0 +1,132 @@
+import re
+
+# Desc: Registry of the HealthKit types extracted from export.xml, one entry per type in dataTypes.txt plus the workouts
+#       Every entry declares the output columns of the type, its unit and the dtype of its value, the extraction function of a type is
+#       generated from its columns (see compile_extractor() in columnar.py) so each record only costs the attribute lookups the type needs
+
+# export.xml attribute each column is read from, "date" is the creation date (YYYY-MM-DD) and "value" is renamed to the type's valueColumn
+COLUMN_ATTRIBUTES = {
+    "date": "creationDate",
+    "time": "creationDate",
+    "startTime": "startDate",
+    "endTime": "endDate",
+    "value": "value",
+    "source": "sourceName",
+    "device": "device",
+    "unit": "unit",
+    "activityType": "workoutActivityType",
+}
+
+# Workout elements have no type attribute, they are extracted as this type (the HealthKit identifier of workouts)
+WORKOUT_TYPE = "HKWorkoutTypeIdentifier"
+
+# default columns of interval samples (most quantity types), of category samples (e.g. sleep stages) and of workouts
+QUANTITY_TYPE_COLUMNS = ("startTime", "endTime", "value", "unit", "source")
+CATEGORY_TYPE_COLUMNS = ("startTime", "endTime", "value", "source")
+WORKOUT_TYPE_COLUMNS = ("startTime", "endTime", "activityType", "source")
+
+# quantity types whose values add up over time (HKQuantityAggregationStyleCumulative), overlapping samples of these are prorated when
+# the sources are merged (see deduplication.py), the other quantity types are discrete (e.g. averages such as step length)
+CUMULATIVE_TYPES = {
+    "HKQuantityTypeIdentifierStepCount",
+    "HKQuantityTypeIdentifierDistanceWalkingRunning",
+    "HKQuantityTypeIdentifierDistanceCycling",
+    "HKQuantityTypeIdentifierBasalEnergyBurned",
+    "HKQuantityTypeIdentifierActiveEnergyBurned",
+    "HKQuantityTypeIdentifierFlightsClimbed",
+    "HKQuantityTypeIdentifierAppleExerciseTime",
+    "HKQuantityTypeIdentifierAppleStandTime",
+    "HKQuantityTypeIdentifierTimeInDaylight",
+}
+
+
+# Desc: Builds a registry entry
+# Input: dataTypeString (e.g. HKQuantityTypeIdentifierStepCount), unit of the type (None for category types and workouts) and optionally the columns
+#        (see COLUMN_ATTRIBUTES, the date column is always added first), the output file name and the name of the value column
+#        (by default both are derived from the type name, e.g. step_count_data and stepCount)
+# Output: Dictionary, including whether the values are cumulative and whether overlapping samples of different sources are merged
+def data_type(dataTypeString, unit, columns=None, outputFileName=None, valueColumn=None):
+    if dataTypeString == WORKOUT_TYPE:
+        kind = "workout"
+    else:
+        kind = "category" if dataTypeString.startswith("HKCategoryTypeIdentifier") else "quantity"
+    name = dataTypeString.replace("HKQuantityTypeIdentifier", "").replace("HKCategoryTypeIdentifier", "")
+    if columns is None:
+        columns = {"category": CATEGORY_TYPE_COLUMNS, "workout": WORKOUT_TYPE_COLUMNS}.get(kind, QUANTITY_TYPE_COLUMNS)
+    columns = ("date",) + tuple(columns)
+    return {
+        "dataTypeString": dataTypeString,
+        "kind": kind,
+        "unit": unit,
+        # category values are strings such as HKCategoryValueSleepAnalysisAsleepCore, workouts hold their activity type
+        "dtype": "float64" if kind == "quantity" else "category",
+        "valueColumn": valueColumn or name[0].lower() + name[1:],
+        "columns": columns,
+        "outputFileName": outputFileName or re.sub(r"(?<=[a-z0-9])(?=[A-Z])", "_", name).lower() + "_data",
+        "cumulative": dataTypeString in CUMULATIVE_TYPES,
+        # interval samples recorded by several sources (e.g. the iPhone and the Watch both counting steps) are merged by source priority
+        "deduplicate": kind == "quantity" and {"startTime", "endTime", "source"} <= set(columns),
+    }
+
+
+DATA_TYPES = [
+    # point samples keep their creation time and the time they were measured at (startTime), which can be much earlier, e.g. the heart
+    # rate of a workout is written when the workout ends
+    data_type("HKQuantityTypeIdentifierHeartRate", "count/min", ("value", "time", "startTime"), "heart_rate_data", "heartRate"),
+    data_type("HKQuantityTypeIdentifierRestingHeartRate", "count/min", ("value", "time", "startTime"), "resting_heart_rate_data", "heartRate"),
+    data_type("HKQuantityTypeIdentifierHeartRateVariabilitySDNN", "ms", ("value", "time", "startTime"), "heart_rate_variability_data", "heartRateVariability"),
+    data_type("HKQuantityTypeIdentifierStepCount", "count", ("startTime", "endTime", "value", "source"), "steps_data", "steps"),
+    data_type("HKQuantityTypeIdentifierWalkingStepLength", "cm", ("startTime", "endTime", "value", "unit", "source"), "gait_length_data", "gaitLength"),
+    data_type("HKQuantityTypeIdentifierEnvironmentalAudioExposure", "dBASPL", ("startTime", "endTime", "value", "unit", "device")),
+    data_type("HKQuantityTypeIdentifierHeadphoneAudioExposure", "dBASPL", ("startTime", "endTime", "value", "unit", "device")),
+    data_type("HKQuantityTypeIdentifierTimeInDaylight", "min", ("startTime", "endTime", "value", "unit"), "time_in_daylight_data", "timeInDayLightValue"),
+    data_type("HKQuantityTypeIdentifierOxygenSaturation", "%", ("startTime", "endTime", "value", "source", "unit"), "spo2_data", "SpO2"),
+    data_type("HKQuantityTypeIdentifierHeight", "cm"),
+    data_type("HKQuantityTypeIdentifierBodyMass", "lb"),
+    data_type("HKQuantityTypeIdentifierDistanceWalkingRunning", "km"),
+    data_type("HKQuantityTypeIdentifierBasalEnergyBurned", "kcal"),
+    data_type("HKQuantityTypeIdentifierActiveEnergyBurned", "kcal"),
+    data_type("HKQuantityTypeIdentifierFlightsClimbed", "count"),
+    data_type("HKQuantityTypeIdentifierAppleExerciseTime", "min"),
+    data_type("HKQuantityTypeIdentifierDistanceCycling", "km"),
+    data_type("HKQuantityTypeIdentifierVO2Max", "mL/min·kg", valueColumn="vo2Max"),
+    data_type("HKQuantityTypeIdentifierWalkingHeartRateAverage", "count/min"),
+    data_type("HKQuantityTypeIdentifierWalkingDoubleSupportPercentage", "%"),
+    data_type("HKQuantityTypeIdentifierSixMinuteWalkTestDistance", "m"),
+    data_type("HKQuantityTypeIdentifierAppleStandTime", "min"),
+    data_type("HKQuantityTypeIdentifierWalkingSpeed", "km/hr"),
+    data_type("HKQuantityTypeIdentifierWalkingAsymmetryPercentage", "%"),
+    data_type("HKQuantityTypeIdentifierStairAscentSpeed", "m/s"),
+    data_type("HKQuantityTypeIdentifierStairDescentSpeed", "m/s"),
+    data_type("HKQuantityTypeIdentifierAppleWalkingSteadiness", "%"),
+    data_type("HKQuantityTypeIdentifierHeartRateRecoveryOneMinute", "count/min"),
+    data_type("HKQuantityTypeIdentifierPhysicalEffort", "kcal/hr·kg"),
+    data_type("HKCategoryTypeIdentifierSleepAnalysis", None, valueColumn="sleepStage"),
+    data_type("HKCategoryTypeIdentifierAppleStandHour", None, valueColumn="standHour"),
+    data_type("HKCategoryTypeIdentifierMindfulSession", None, valueColumn="mindfulSession"),
+    data_type(WORKOUT_TYPE, None, outputFileName="workout_data", valueColumn="activityType"),
+]
+
+
+# Desc: Short name of the device a measurement was taken with
+# Input: sourceName attribute
+# Output: "iPhone", "Watch" or "Other"
+def source_name(sourceName):
+    if sourceName is None:
+        return "Other"
+    if "iPhone" in sourceName:
+        return "iPhone"
+    elif "Watch" in sourceName:
+        return "Watch"
+    return "Other"
+
+
+# Desc: Device name from the device attribute, e.g. "Apple Watch" from "<<HKDevice: 0x...>, name:Apple Watch, manufacturer:...>"
+# Input: device attribute (or None)
+# Output: Device name (None if the attribute is missing)
+def device_name(device):
+    if device is None:
+        return None
+    start = device.find("name:") + len("name:")
+    end = device.find(",", start)
+    return device[start:end].strip()
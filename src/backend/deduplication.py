@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+# Desc: Source priority merge of overlapping samples, the same way the Health app counts a period recorded by both the iPhone and the
+#       Watch only once: the parts of a sample covered by a sample of a higher priority source are removed. The overlaps are resolved
+#       with a sorted sweep over numpy arrays (O(n log n)): the intervals of the higher priority sources are merged into a sorted union
+#       and every sample is cut to the gaps of that union with searchsorted
+
+# sources (see source_name() in data_types.py) from highest to lowest priority, sources missing from the list come last
+SOURCE_PRIORITY = ["Watch", "iPhone", "Other"]
+
+
+# Desc: Merges intervals into their sorted union
+# Input: int64 arrays of interval starts and ends
+# Output: Tuple of int64 arrays (starts, ends) of the disjoint union intervals, sorted by start
+def merge_intervals(starts, ends):
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = ends[order]
+    # an interval starts a new union interval if it starts after every interval before it has ended
+    runningEnds = np.maximum.accumulate(ends)
+    first = np.flatnonzero(np.r_[True, starts[1:] > runningEnds[:-1]])
+    return starts[first], np.maximum.reduceat(ends, first)
+
+
+# Desc: Cuts intervals to the parts that aren't covered by a union of intervals (see merge_intervals())
+# Input: int64 arrays of interval starts and ends, and the starts and ends of the union
+# Output: Tuple of arrays (index of the interval every piece belongs to, piece starts, piece ends), pieces of an interval are in time
+#         order, an interval of zero length is kept as a single piece if it isn't covered
+def subtract_intervals(starts, ends, unionStarts, unionEnds):
+    # the gaps between the union intervals, unbounded before the first and after the last one
+    gapStarts = np.r_[np.iinfo(np.int64).min, unionEnds]
+    gapEnds = np.r_[unionStarts, np.iinfo(np.int64).max]
+    # the gaps overlapping an interval are the ones ending after its start and starting before its end
+    firstGaps = np.searchsorted(gapEnds, starts, side="right")
+    lastGaps = np.searchsorted(gapStarts, ends, side="left")
+    pieces = np.maximum(lastGaps - firstGaps, 0)
+
+    rows = np.repeat(np.arange(len(starts)), pieces)
+    # position of every piece within the gaps of its interval
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    gaps = firstGaps[rows] + offsets
+    return rows, np.maximum(starts[rows], gapStarts[gaps]), np.minimum(ends[rows], gapEnds[gaps])
+
+
+# Desc: Resolves the overlaps between samples of different sources, samples of the same source are never compared
+#       Cumulative values (e.g. steps) are prorated: a sample is cut to the periods no higher priority source covers and its value is
+#       split in proportion to the length of every piece. Discrete values (e.g. step length) can't be split, so a sample is kept as a
+#       whole if at least half of it isn't covered and dropped otherwise. The result has no overlaps left between sources, so running
+#       it again doesn't change it, and a sample merged again with the result is cut into the same pieces as its first copy (which is
+#       how append_data_frame() in storage.py recognizes the samples an incremental run reads again)
+# Input: Typed DataFrame with startTime, endTime, source and the value column (see typed_frame() in columnar.py), the name of the
+#        value column, whether the values are cumulative and optionally the source priority
+# Output: DataFrame with the same columns, rows in the same order (a cut sample's pieces take its place)
+def deduplicate_sources(df, valueColumn, cumulative, priority=SOURCE_PRIORITY):
+    if df.empty or "source" not in df.columns:
+        return df
+
+    # timestamps as int64 in the resolution they are stored in
+    startTimes = df["startTime"].dt.tz_localize(None).to_numpy()
+    starts = startTimes.view(np.int64)
+    ends = df["endTime"].dt.tz_localize(None).to_numpy().astype(startTimes.dtype).view(np.int64)
+    sources = df["source"].astype("category")
+    categories = list(sources.cat.categories)
+    # rank of every row's source, the last entry is the rank of missing sources (code -1)
+    sourceRanks = np.array([priority.index(source) if source in priority else len(priority) for source in categories] + [len(priority)])
+    ranks = sourceRanks[sources.cat.codes.to_numpy()]
+
+    rows, pieceStarts, pieceEnds = [], [], []
+    for rank in np.unique(ranks):
+        selected = np.flatnonzero(ranks == rank)
+        # every piece kept so far belongs to a higher priority source
+        unionStarts, unionEnds = merge_intervals(np.concatenate(pieceStarts or [starts[:0]]), np.concatenate(pieceEnds or [ends[:0]]))
+        pieceRows, levelStarts, levelEnds = subtract_intervals(starts[selected], ends[selected], unionStarts, unionEnds)
+        if not cumulative:
+            durations = ends[selected] - starts[selected]
+            uncovered = np.bincount(pieceRows, weights=levelEnds - levelStarts, minlength=len(selected))
+            covered = np.where(durations > 0, uncovered * 2 < durations, np.bincount(pieceRows, minlength=len(selected)) == 0)
+            pieceRows = np.flatnonzero(~covered)
+            levelStarts = starts[selected][pieceRows]
+            levelEnds = ends[selected][pieceRows]
+        rows.append(selected[pieceRows])
+        pieceStarts.append(levelStarts)
+        pieceEnds.append(levelEnds)
+
+    rows = np.concatenate(rows)
+    pieceStarts = np.concatenate(pieceStarts)
+    pieceEnds = np.concatenate(pieceEnds)
+    # back to the order of the input rows, the pieces of a sample are already in time order
+    order = np.argsort(rows, kind="stable")
+    rows = rows[order]
+    pieceStarts = pieceStarts[order]
+    pieceEnds = pieceEnds[order]
+
+    output = df.iloc[rows].reset_index(drop=True)
+    output["startTime"] = pd.to_datetime(pieceStarts.view(startTimes.dtype)).tz_localize("UTC")
+    output["endTime"] = pd.to_datetime(pieceEnds.view(startTimes.dtype)).tz_localize("UTC")
+    if cumulative:
+        durations = ends[rows] - starts[rows]
+        shares = np.where(durations > 0, (pieceEnds - pieceStarts) / np.where(durations > 0, durations, 1), 1.0)
+        output[valueColumn] = output[valueColumn].to_numpy() * shares
+    if "totalTime" in output.columns:
+        output["totalTime"] = (output["endTime"] - output["startTime"]).dt.total_seconds()
+    return output
@@ -0,0 +1,250 @@
+import argparse
+import math
+import os
+import zipfile
+from collections import Counter
+import numpy as np
+from data_types import WORKOUT_TYPE
+
+# Desc: Generator of synthetic Apple Health export.xml files, used to benchmark the pipeline without a personal export
+#       Every type in dataTypes.txt (and workouts) is generated with its typical number of samples per day, source, unit and duration
+
+WATCH = "Alex’s Apple Watch"
+IPHONE = "Alex’s iPhone"
+WATCH_DEVICE = "&lt;&lt;HKDevice: 0x283f7d0e0&gt;, name:Apple Watch, manufacturer:Apple Inc., model:Watch, hardware:Watch6,1, software:10.1&gt;"
+IPHONE_DEVICE = "&lt;&lt;HKDevice: 0x283f7c5a0&gt;, name:iPhone, manufacturer:Apple Inc., model:iPhone, hardware:iPhone14,2, software:17.1&gt;"
+
+# (type, unit, samples per day, (mean, sd) of the value, duration in seconds, sources)
+QUANTITY_TYPES = [
+    ("HKQuantityTypeIdentifierHeartRate", "count/min", 288, (72, 12), 0, [WATCH]),
+    ("HKQuantityTypeIdentifierActiveEnergyBurned", "kcal", 240, (1.2, 0.8), 60, [WATCH]),
+    ("HKQuantityTypeIdentifierBasalEnergyBurned", "kcal", 240, (1.1, 0.1), 60, [WATCH]),
+    ("HKQuantityTypeIdentifierStepCount", "count", 96, (350, 250), 600, [WATCH, IPHONE]),
+    ("HKQuantityTypeIdentifierDistanceWalkingRunning", "km", 96, (0.25, 0.2), 600, [WATCH, IPHONE]),
+    ("HKQuantityTypeIdentifierEnvironmentalAudioExposure", "dBASPL", 48, (65, 10), 1800, [WATCH]),
+    ("HKQuantityTypeIdentifierAppleExerciseTime", "min", 48, (1, 0.5), 60, [WATCH]),
+    ("HKQuantityTypeIdentifierAppleStandTime", "min", 48, (2, 1), 300, [WATCH]),
+    ("HKQuantityTypeIdentifierWalkingStepLength", "cm", 24, (70, 6), 600, [IPHONE]),
+    ("HKQuantityTypeIdentifierWalkingSpeed", "km/hr", 24, (4.5, 0.6), 600, [IPHONE]),
+    ("HKQuantityTypeIdentifierWalkingDoubleSupportPercentage", "%", 24, (0.28, 0.03), 600, [IPHONE]),
+    ("HKQuantityTypeIdentifierPhysicalEffort", "kcal/hr·kg", 24, (2, 1), 60, [WATCH]),
+    ("HKQuantityTypeIdentifierOxygenSaturation", "%", 12, (0.97, 0.015), 0, [WATCH]),
+    ("HKQuantityTypeIdentifierTimeInDaylight", "min", 12, (8, 5), 900, [WATCH]),
+    ("HKQuantityTypeIdentifierWalkingAsymmetryPercentage", "%", 8, (0.03, 0.02), 600, [IPHONE]),
+    ("HKQuantityTypeIdentifierHeartRateVariabilitySDNN", "ms", 6, (45, 15), 60, [WATCH]),
+    ("HKQuantityTypeIdentifierHeadphoneAudioExposure", "dBASPL", 6, (70, 8), 1800, [IPHONE]),
+    ("HKQuantityTypeIdentifierFlightsClimbed", "count", 6, (2, 1), 600, [WATCH, IPHONE]),
+    ("HKQuantityTypeIdentifierStairAscentSpeed", "m/s", 2, (0.4, 0.1), 30, [IPHONE]),
+    ("HKQuantityTypeIdentifierStairDescentSpeed", "m/s", 2, (0.45, 0.1), 30, [IPHONE]),
+    ("HKQuantityTypeIdentifierRestingHeartRate", "count/min", 1, (58, 4), 0, [WATCH]),
+    ("HKQuantityTypeIdentifierWalkingHeartRateAverage", "count/min", 1, (95, 8), 0, [WATCH]),
+    ("HKQuantityTypeIdentifierDistanceCycling", "km", 0.5, (8, 3), 1800, [WATCH]),
+    ("HKQuantityTypeIdentifierVO2Max", "mL/min·kg", 0.2, (40, 3), 0, [WATCH]),
+    ("HKQuantityTypeIdentifierSixMinuteWalkTestDistance", "m", 0.14, (550, 30), 0, [IPHONE]),
+    ("HKQuantityTypeIdentifierAppleWalkingSteadiness", "%", 0.14, (0.9, 0.05), 0, [IPHONE]),
+    ("HKQuantityTypeIdentifierHeartRateRecoveryOneMinute", "count/min", 0.1, (25, 5), 60, [WATCH]),
+    ("HKQuantityTypeIdentifierBodyMass", "lb", 0.1, (170, 3), 0, [IPHONE]),
+    ("HKQuantityTypeIdentifierHeight", "cm", 0.01, (178, 0), 0, [IPHONE]),
+]
+
+# (type, samples per day, possible values, duration in seconds, sources)
+CATEGORY_TYPES = [
+    ("HKCategoryTypeIdentifierAppleStandHour", 16, ["HKCategoryValueAppleStandHourStood", "HKCategoryValueAppleStandHourIdle"], 3600, [WATCH]),
+    ("HKCategoryTypeIdentifierSleepAnalysis", 8, ["HKCategoryValueSleepAnalysisAsleepCore", "HKCategoryValueSleepAnalysisAsleepDeep", "HKCategoryValueSleepAnalysisAsleepREM", "HKCategoryValueSleepAnalysisAwake"], 2700, [WATCH]),
+    ("HKCategoryTypeIdentifierMindfulSession", 0.3, [None], 600, [WATCH]),
+]
+
+# (workouts per day, activity types, duration in seconds, sources), written as Workout elements
+WORKOUTS = (0.7, ["HKWorkoutActivityTypeWalking", "HKWorkoutActivityTypeRunning", "HKWorkoutActivityTypeCycling", "HKWorkoutActivityTypeTraditionalStrengthTraining"], 2400, [WATCH])
+
+# files attached to the records in export.zip (see generate_archive()): a 30 second electrocardiogram sampled at 512 Hz and a route with one
+# track point per second of a 40 minute outdoor workout
+ECG_SAMPLES = 30 * 512
+ROUTE_POINTS = 2400
+
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE HealthData [
+<!ELEMENT HealthData (ExportDate,Me,(Record|Correlation|Workout|ActivitySummary|ClinicalRecord|Audiogram|VisionPrescription)*)>
+<!ATTLIST HealthData
+  locale CDATA #REQUIRED
+>
+]>
+<HealthData locale="en_US">
+ <ExportDate value="{exportDate}"/>
+ <Me HKCharacteristicTypeIdentifierDateOfBirth="1990-01-01" HKCharacteristicTypeIdentifierBiologicalSex="HKBiologicalSexNotSet" HKCharacteristicTypeIdentifierBloodType="HKBloodTypeNotSet" HKCharacteristicTypeIdentifierFitzpatrickSkinType="HKFitzpatrickSkinTypeNotSet" HKCharacteristicTypeIdentifierCardioFitnessMedicationsUse="None"/>
+"""
+
+# records generated and written at once per type
+CHUNK_SIZE = 500000
+
+
+# Desc: First Sunday on or after each day
+# Input: numpy array of datetime64[D] days
+# Output: numpy array of datetime64[D] days
+def next_sunday(days):
+    # 1970-01-01 was a Thursday, so (days since the epoch + 3) % 7 is the weekday with Monday as 0
+    weekdays = (days.astype(np.int64) + 3) % 7
+    return days + ((6 - weekdays) % 7).astype("timedelta64[D]")
+
+
+# Desc: Formats UTC epoch seconds as export.xml timestamps in US Eastern time, daylight saving time (-0400) runs from 2:00 on the second
+#       Sunday of March to 2:00 on the first Sunday of November (the US rules since 2007), standard time (-0500) otherwise
+# Input: numpy array of epoch seconds
+# Output: numpy array of "YYYY-MM-DD HH:MM:SS -0500" strings
+def format_timestamps(epochSeconds):
+    utc = epochSeconds.astype("datetime64[s]")
+    months = utc.astype("datetime64[Y]").astype("datetime64[M]")
+    # the transitions in UTC: 2:00 EST is 7:00 UTC and 2:00 EDT is 6:00 UTC
+    daylightStart = (next_sunday((months + 2).astype("datetime64[D]")) + np.timedelta64(7, "D")).astype("datetime64[s]") + np.timedelta64(7, "h")
+    daylightEnd = next_sunday((months + 10).astype("datetime64[D]")).astype("datetime64[s]") + np.timedelta64(6, "h")
+    daylightSaving = (utc >= daylightStart) & (utc < daylightEnd)
+    local = utc + np.where(daylightSaving, -4 * 3600, -5 * 3600).astype("timedelta64[s]")
+    localStrings = np.char.replace(np.datetime_as_string(local, unit="s"), "T", " ")
+    return np.char.add(localStrings, np.where(daylightSaving, " -0400", " -0500"))
+
+
+# Desc: Generates the sorted sample start times of a single type as a Poisson process over the time span, chunk by chunk
+# Input: Random generator, number of samples, start of the span and its length (epoch seconds)
+# Output: Generator of sorted numpy arrays of epoch seconds
+def sample_times(rng, count, start, span):
+    meanGap = span / max(count, 1)
+    current = float(start)
+    remaining = count
+    while remaining > 0:
+        size = min(remaining, CHUNK_SIZE)
+        times = current + np.cumsum(rng.exponential(meanGap, size))
+        current = times[-1]
+        remaining -= size
+        yield np.minimum(times, start + span - 1).astype(np.int64)
+
+
+# Desc: Writes the records of a single type (or the workouts)
+# Input: Output file, random generator, type definition, number of records, start and length of the span (epoch seconds)
+# Output: None
+def write_type(file, rng, dataTypeString, unit, count, valueFunction, duration, sources, start, span):
+    devices = {WATCH: WATCH_DEVICE, IPHONE: IPHONE_DEVICE}
+    for times in sample_times(rng, count, start, span):
+        size = len(times)
+        startDates = format_timestamps(times)
+        endDates = format_timestamps(times + duration) if duration else startDates
+        # samples are written to Health a few seconds to minutes after they end
+        creationDates = format_timestamps(times + duration + rng.integers(1, 300, size))
+        values = valueFunction(times, size)
+        sourceIndexes = rng.integers(0, len(sources), size)
+
+        unitAttribute = f' unit="{unit}"' if unit else ""
+        lines = []
+        for creationDate, startDate, endDate, value, sourceIndex in zip(creationDates.tolist(), startDates.tolist(), endDates.tolist(), values, sourceIndexes.tolist()):
+            source = sources[sourceIndex]
+            if dataTypeString == WORKOUT_TYPE:
+                lines.append(
+                    f' <Workout workoutActivityType="{value}" duration="{duration / 60:g}" durationUnit="min" sourceName="{source}" sourceVersion="10.1"'
+                    f' device="{devices[source]}" creationDate="{creationDate}" startDate="{startDate}" endDate="{endDate}"/>\n'
+                )
+                continue
+            valueAttribute = f' value="{value}"' if value is not None else ""
+            lines.append(
+                f' <Record type="{dataTypeString}" sourceName="{source}" sourceVersion="10.1" device="{devices[source]}"{unitAttribute}'
+                f' creationDate="{creationDate}" startDate="{startDate}" endDate="{endDate}"{valueAttribute}/>\n'
+            )
+        file.write("".join(lines))
+
+
+# Desc: Generates a synthetic export.xml
+# Input: Output path, total number of records, random seed, first day (YYYY-MM-DD) and optionally the number of days covered
+#        (default: the number of days a real export with that many records covers, at most a year so the records stay in one year)
+# Output: None
+def generate_export(outputFile, records, seed=0, startDay="2023-01-01", days=None):
+    rng = np.random.default_rng(seed)
+    types = [(dataTypeString, unit, perDay, ("quantity", meanSd), duration, sources) for dataTypeString, unit, perDay, meanSd, duration, sources in QUANTITY_TYPES]
+    types += [(dataTypeString, None, perDay, ("category", values), duration, sources) for dataTypeString, perDay, values, duration, sources in CATEGORY_TYPES]
+    perDay, activityTypes, duration, sources = WORKOUTS
+    types += [(WORKOUT_TYPE, None, perDay, ("category", activityTypes), duration, sources)]
+    samplesPerDay = sum(definition[2] for definition in types)
+    if days is None:
+        days = min(365, max(1, math.ceil(records / samplesPerDay)))
+
+    # split the records across the types in proportion to their sampling rate
+    counts = [int(records * definition[2] / samplesPerDay) for definition in types]
+    counts[0] += records - sum(counts)
+
+    start = int(np.datetime64(startDay, "s").astype(np.int64)) + 5 * 3600
+    span = days * 86400
+
+    def value_function(kind, parameters):
+        if kind == "category":
+            return lambda times, size: [parameters[index] for index in rng.integers(0, len(parameters), size).tolist()]
+        mean, sd = parameters
+        decimals = 0 if mean >= 20 and sd >= 1 else 4
+
+        def values(times, size):
+            # a daily rhythm (peak in the afternoon) on top of the noise
+            hours = (times // 3600) % 24
+            rhythm = 0.5 * sd * np.sin((hours - 9) / 24 * 2 * np.pi)
+            values = np.round(np.abs(rng.normal(mean, sd, size) + rhythm), decimals)
+            return (values.astype(np.int64) if decimals == 0 else values).tolist()
+        return values
+
+    os.makedirs(os.path.dirname(outputFile) or ".", exist_ok=True)
+    with open(outputFile, "w", encoding="utf-8") as file:
+        file.write(HEADER.format(exportDate=format_timestamps(np.array([start + span]))[0]))
+        for (dataTypeString, unit, perDay, (kind, parameters), duration, sources), count in zip(types, counts):
+            write_type(file, rng, dataTypeString, unit, count, value_function(kind, parameters), duration, sources, start, span)
+        file.write("</HealthData>\n")
+
+
+# Desc: Generates a synthetic export.zip: the export.xml, electrocardiograms (electrocardiograms/ecg_YYYY-MM-DD.csv) and workout routes
+#       (workout-routes/route_YYYY-MM-DD_h.mmpm.gpx), spread evenly over the days, in the layout written by the Health app
+# Input: Output path, path of the export.xml to include (see generate_export()), number of electrocardiograms and routes, random seed,
+#        first day (YYYY-MM-DD) and the number of days covered
+# Output: None
+def generate_archive(outputFile, exportFile, ecgs, routes, seed=0, startDay="2023-01-01", days=365):
+    rng = np.random.default_rng(seed)
+    start = int(np.datetime64(startDay, "s").astype(np.int64)) + 5 * 3600
+    os.makedirs(os.path.dirname(outputFile) or ".", exist_ok=True)
+    with zipfile.ZipFile(outputFile, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write(exportFile, "apple_health_export/export.xml")
+
+        # recorded in the morning, a second recording of the same day is named ecg_YYYY-MM-DD_1.csv
+        names = Counter()
+        for recordedDate in format_timestamps(start + 9 * 3600 + np.arange(ecgs) * days // ecgs * 86400).tolist():
+            voltages = np.round(rng.normal(0, 150, ECG_SAMPLES), 3).astype(str)
+            header = (
+                f'Name,Alex\nRecorded Date,{recordedDate}\nClassification,Sinus Rhythm\nSymptoms,\nSoftware Version,1.90\n'
+                f'Device,"Watch6,1"\nSample Rate,512 hertz\nLead,Lead I\nUnit,µV\n\n'
+            )
+            suffix = f"_{names[recordedDate[0:10]]}" if names[recordedDate[0:10]] else ""
+            names[recordedDate[0:10]] += 1
+            archive.writestr(f"apple_health_export/electrocardiograms/ecg_{recordedDate[0:10]}{suffix}.csv", header + "\n".join(voltages) + "\n")
+
+        # started in the evening (a few minutes apart on the same day), the file name holds the local start time and the track points are in UTC
+        for routeStart in (start + 17 * 3600 + np.arange(routes) * days // routes * 86400 + np.arange(routes) % 120 * 60).tolist():
+            localStart = format_timestamps(np.array([routeStart]))[0]
+            hour = int(localStart[11:13])
+            name = f"route_{localStart[0:10]}_{(hour - 1) % 12 + 1}.{localStart[14:16]}{'am' if hour < 12 else 'pm'}.gpx"
+            times = np.char.add(np.datetime_as_string((routeStart + np.arange(ROUTE_POINTS)).astype("datetime64[s]"), unit="s"), "Z")
+            latitudes = 42 + np.cumsum(rng.normal(0, 0.00002, ROUTE_POINTS))
+            longitudes = -71 + np.cumsum(rng.normal(0, 0.00002, ROUTE_POINTS))
+            elevations = 10 + np.cumsum(rng.normal(0, 0.05, ROUTE_POINTS))
+            speeds = np.abs(rng.normal(2.5, 0.5, ROUTE_POINTS))
+            points = "".join(
+                f'<trkpt lon="{longitude:.6f}" lat="{latitude:.6f}"><ele>{elevation:.2f}</ele><time>{time}</time><extensions><speed>{speed:.2f}</speed>'
+                f'<course>{course}</course><hAcc>3</hAcc><vAcc>2</vAcc></extensions></trkpt>\n'
+                for latitude, longitude, elevation, time, speed, course in zip(latitudes, longitudes, elevations, times.tolist(), speeds, rng.integers(0, 360, ROUTE_POINTS).tolist())
+            )
+            archive.writestr(
+                f"apple_health_export/workout-routes/{name}",
+                f'<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n{points}</trkseg></trk></gpx>\n',
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Apple Health export.xml")
+    parser.add_argument("output", help="path of the export.xml file to write")
+    parser.add_argument("--records", type=int, default=100000, help="total number of records (default: 100000)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--start-day", default="2023-01-01", help="first day of the export, YYYY-MM-DD (default: 2023-01-01)")
+    parser.add_argument("--days", type=int, default=None, help="number of days covered (default: depends on the number of records, at most 365)")
+    args = parser.parse_args()
+
+    generate_export(args.output, args.records, args.seed, args.start_day, args.days)
@@ -0,0 +1,164 @@
+import cProfile
+import json
+import multiprocessing
+import os
+import pstats
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+# counters recorded per stage, rolled up into the enclosing stage, workerCpuSeconds is the CPU time of the stages run by worker processes
+COUNTERS = ["recordsScanned", "recordsMatched", "recordsSkipped", "bytesWritten", "cacheHits", "workerCpuSeconds"]
+
+
+# Desc: Current and peak resident set size of the process
+# Input: None
+# Output: Peak RSS in bytes since the last reset_peak_rss() (since the process started if it can't be reset)
+def peak_rss():
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+# Desc: Resets the peak RSS (VmHWM) so the next peak_rss() only covers what happens from now on, Linux only
+# Input: None
+# Output: True if the peak was reset
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class RunReport:
+    # Desc: Records wall time, CPU time, peak memory and counters for every stage of a run
+    def __init__(self) -> None:
+        self.startedAt = datetime.now().isoformat(timespec="seconds")
+        self.stages = []
+        self.active = []
+        self.profileStage = None
+        self.profiler = None
+        # cProfile stats of the profiled stages that ran in worker processes (see add_worker_stage())
+        self.workerProfiles = []
+        # in a worker process, the names of the stages of the parent process the worker runs in (see init_worker())
+        self.parentStages = []
+
+    # Desc: Context manager that measures a stage, stages can be nested (e.g. one write stage per data type inside data_extract)
+    # Input: Stage name and optionally the data type the stage works on
+    # Output: Stage record (dictionary), filled in when the stage ends
+    @contextmanager
+    def stage(self, name, dataType=None):
+        record = {
+            "name": name,
+            "path": "/".join([parent["name"] for parent in self.active] + [name]),
+            "dataType": dataType,
+            **dict.fromkeys(COUNTERS, 0),
+        }
+        # the peak of the enclosing stage so far has to be kept before the peak is reset for this stage
+        if self.active:
+            self.active[-1]["peakRssBytes"] = max(self.active[-1]["peakRssBytes"], peak_rss())
+        record["peakRssBytes"] = 0
+        reset_peak_rss()
+
+        # the stages of a worker process are also profiled if they run in the profiled stage of the parent process
+        profiling = self.profiler is not None and (name == self.profileStage or (not self.active and self.profileStage in self.parentStages))
+        # a worker process profiles every stage on its own, the stats are sent back to the parent with the stage record
+        profiler = cProfile.Profile() if profiling and multiprocessing.parent_process() is not None else self.profiler
+        if profiling:
+            profiler.enable()
+        self.active.append(record)
+        startWall = time.perf_counter()
+        startCpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wallSeconds"] = time.perf_counter() - startWall
+            # the CPU time of the worker processes isn't part of the process time of this process
+            record["cpuSeconds"] = time.process_time() - startCpu + record["workerCpuSeconds"]
+            if profiling:
+                profiler.disable()
+                if profiler is not self.profiler:
+                    profiler.create_stats()
+                    record["profileStats"] = profiler.stats
+            record["peakRssBytes"] = max(record["peakRssBytes"], peak_rss())
+            self.active.pop()
+            if self.active:
+                parent = self.active[-1]
+                parent["peakRssBytes"] = max(parent["peakRssBytes"], record["peakRssBytes"])
+                for counter in COUNTERS:
+                    parent[counter] += record[counter]
+            self.stages.append(record)
+
+    # Desc: Adds to the counters of the innermost active stage, counts made outside of a stage are ignored
+    # Input: Counters as keyword arguments, e.g. count(recordsScanned=10)
+    # Output: None
+    def count(self, **counters):
+        if self.active:
+            for counter, value in counters.items():
+                self.active[-1][counter] += value
+
+    # Desc: Adds the finished stage of a worker process (see map_shards() in main.py) as a child of the innermost active stage, its
+    #       counters and CPU time are rolled up and the peak RSS of the enclosing stage is the max of its own peak and the worker's
+    # Input: Stage record returned by the worker
+    # Output: None
+    def add_worker_stage(self, record):
+        if not self.active:
+            return
+        parent = self.active[-1]
+        record = dict(record, path=parent["path"] + "/" + record["name"])
+        if "profileStats" in record:
+            self.workerProfiles.append(record.pop("profileStats"))
+        parent["peakRssBytes"] = max(parent["peakRssBytes"], record["peakRssBytes"])
+        for counter in COUNTERS:
+            parent[counter] += record[counter]
+        # the whole CPU time of the worker stage is worker CPU time for the enclosing stages (its workerCpuSeconds were added above)
+        parent["workerCpuSeconds"] += record["cpuSeconds"] - record["workerCpuSeconds"]
+        self.stages.append(record)
+
+    # Desc: Profiles every occurrence of a stage with cProfile
+    # Input: Stage name
+    # Output: None
+    def profile(self, stageName):
+        self.profileStage = stageName
+        self.profiler = cProfile.Profile()
+
+    # Desc: Writes the report as JSON and, if a stage was profiled, its cProfile dump (loadable with pstats) next to it
+    # Input: Path of the JSON report
+    # Output: None
+    def write(self, outputFile):
+        os.makedirs(os.path.dirname(outputFile) or ".", exist_ok=True)
+        with open(outputFile, "w") as file:
+            json.dump({"startedAt": self.startedAt, "stages": self.stages}, file, indent=4)
+        if self.profiler is not None:
+            # the stats of this process and of the worker processes are combined into a single dump
+            self.profiler.create_stats()
+            stats = pstats.Stats()
+            for profile in [self.profiler.stats] + self.workerProfiles:
+                if profile:
+                    stats.add(SimpleNamespace(create_stats=lambda: None, stats=profile))
+            stats.dump_stats(os.path.splitext(outputFile)[0] + f"_{self.profileStage}.prof")
+
+
+# run report shared by the pipeline modules
+report = RunReport()
+
+
+# Desc: Initializer of the worker processes (see map_shards() in main.py), the workers profile the same stage as the parent process
+# Input: Name of the profiled stage (None if no stage is profiled) and the names of the active stages of the parent process
+# Output: None
+def init_worker(profileStage, parentStages):
+    # a forked worker inherits the report of the parent process, its stages are recorded in an empty one
+    report.__init__()
+    report.parentStages = parentStages
+    if profileStage is not None:
+        report.profile(profileStage)
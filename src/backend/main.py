@@ -1,376 +1,747 @@
 import xml.etree.ElementTree as ET
-import json
 import csv
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import time
-from statistical_tests import StatisticalTest
+from statistical_tests import StatisticalTest, DESCRIPTIVE_STATISTICS_FILES
+from query_store import QueryStore
+from instrumentation import report, init_worker
+from online_statistics import OnlineStatistics
+from stage_cache import StageCache, code_fingerprint, DEFAULT_MAX_BYTES
+from data_types import DATA_TYPES, WORKOUT_TYPE
+from columnar import new_buffers, bind_extractor, constant_column, typed_frame
+from storage import parquet_path, partition_paths, sample_keys, write_data_frame, write_csv, append_data_frame, read_data_type, read_watermarks, write_watermarks, parse_timestamps, WATERMARK_FORMAT
+from deduplication import deduplicate_sources
+from contexts import join_contexts, read_contexts
+from archive import is_archive, open_export, archive_members, ATTACHMENTS, BATCH_SIZE
+from rollups import build_rollups, rollup_path, RESOLUTIONS
 import os
+import io
+import mmap
+import math
+import json
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+# point samples whose statistics are split by context (see contexts.py)
+CONTEXT_METRICS = ["HKQuantityTypeIdentifierHeartRate", "HKQuantityTypeIdentifierHeartRateVariabilitySDNN", "HKQuantityTypeIdentifierOxygenSaturation"]
+
+# Desc: Streams the top level Record (and Workout) elements out of export.xml without building the whole tree
+# Input: Path (or file object) of the export.xml file
+# Output: Generator of Record and Workout elements, each element is cleared once the caller moves on to the next one
+#         Workouts have no type attribute, get("type", WORKOUT_TYPE) gives the type of either element
+def iter_records(exportFile):
+    root = None
+    depth = 0
+    scanned = 0
+    for event, elem in ET.iterparse(exportFile, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        # only direct children of HealthData are records, Records nested in a Correlation are skipped (same as iterating root)
+        if depth == 1:
+            if elem.tag == "Record" or elem.tag == "Workout":
+                scanned += 1
+                yield elem
+            # drop the finished element (and its MetadataEntry children) so memory stays bounded
+            root.clear()
+    report.count(recordsScanned=scanned)
+
+# Desc: Collects the records for every data type passed to the function in a single pass over export.xml
+# Input: export.xml path (or file object), a list of data type dictionaries (see static_data()) and optionally the per type and year
+#        watermarks ((dataTypeString, year) -> creation datetime) of a previous run, records created before the watermark are skipped
+# Output: List of column buffers (one per data type, same order as objects, see new_buffers()) and, when watermarks are passed,
+#         a dictionary with the latest creation datetime collected per (dataTypeString, year)
+def collect_records(exportFile, objects, watermarks=None):
+    if watermarks is not None:
+        # timezone offsets are less than two days apart, so any record whose local creation time sorts before the watermark minus two days
+        # is older than the watermark and can be skipped with a string comparison
+        watermarkFloors = {
+            key: (watermark - timedelta(days=2)).strftime("%Y-%m-%d %H:%M:%S")
+            for key, watermark in watermarks.items()
+        }
+        ingestedDates = {}
+
+    # route each record type to the compiled extractors (sinks) of the data types that want it
+    sinks = {}
+    results = []
+    for object in objects:
+        buffers = new_buffers(object)
+        results.append(buffers)
+        sinks.setdefault(object["dataTypeString"], []).append((object["year"], bind_extractor(object, buffers)))
+
+    for child in iter_records(exportFile):
+        # filter on type and year before doing any other parsing
+        get = child.attrib.get
+        dataTypeString = get("type", WORKOUT_TYPE)
+        typeSinks = sinks.get(dataTypeString)
+        if typeSinks is None:
+            continue
+        creationDateTime = get("creationDate")
+        creationYear = creationDateTime[0:4]
+        matchingSinks = [extract for year, extract in typeSinks if year == creationYear]
+        if not matchingSinks:
+            continue
+
+        # incremental mode: skip records that were already ingested into the partition of their year by a previous run
+        if watermarks is not None:
+            key = (dataTypeString, creationYear)
+            watermark = watermarks.get(key)
+            if watermark is not None:
+                if creationDateTime[:19] < watermarkFloors[key]:
+                    continue
+                # only the records close to (or after) the watermark need an exact comparison
+                if datetime.strptime(creationDateTime, WATERMARK_FORMAT) < watermark:
+                    continue
+            ingestedDates.setdefault(key, []).append(creationDateTime)
+
+        for extract in matchingSinks:
+            extract(get)
+
+    latestDates = {}
+    if watermarks is not None:
+        # convert the ingested creation dates in bulk and keep the latest one per type and year
+        for key, creationDateTimes in ingestedDates.items():
+            epochSeconds, utcOffsets = parse_timestamps(creationDateTimes)
+            latest = epochSeconds.argmax()
+            latestDates[key] = datetime.fromtimestamp(int(epochSeconds[latest]), timezone(timedelta(minutes=int(utcOffsets[latest]))))
+
+    return results, latestDates
+
+# Desc: Writes the extracted data for a single data type
+# Input: Data type dictionary, the extracted column buffers (see collect_records(), with an export column when they were collected from
+#        several exports), whether to append to the existing file and in append mode the watermark of the previous run
+# Output: A typed parquet file that contains all of the extracted data for the specified data type and year
+def write_data_type(object, buffers, append=False, watermark=None):
+    df = typed_frame(object, buffers)
+    if "export" in df.columns:
+        # a record found in several exports (e.g. two exports of the same account) is only kept from the first export holding it,
+        # identical records within an export are distinct samples and are all kept
+        exports = df.pop("export").cat.codes.to_numpy()
+        firstExports = pd.Series(exports).groupby(sample_keys(df)).transform("min").to_numpy()
+        df = df[exports == firstExports].reset_index(drop=True)
+    report.count(recordsMatched=len(df))
+    # periods recorded by several sources are only counted once (see deduplication.py), in append mode the new samples are merged
+    # with the stored ones
+    merge = None
+    if object["deduplicate"]:
+        merge = lambda df: deduplicate_sources(df, object["valueColumn"], object["cumulative"])
+    if append:
+        # the records read again are the ones created at the watermark, the date column is the local creation date so the stored samples
+        # are compared from the day before the watermark on, whatever their timezone
+        since = pd.Timestamp(watermark.date()) - pd.Timedelta(days=1) if watermark is not None else None
+        append_data_frame(df, object["outputFileName"], object["year"], merge, since)
+    else:
+        write_data_frame(df if merge is None else merge(df), object["outputFileName"], object["year"])
+
+# Desc: Splits the body of export.xml into byte ranges that each start on a top level element
+# Input: export.xml path and the number of shards to split the file into
+# Output: List of (start, end) byte offsets, in file order
+def shard_export(exportFile, shards):
+    with open(exportFile, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # the body starts after the opening HealthData tag (skipping the xml declaration and DTD) and ends before the closing tag
+        bodyStart = mm.find(b">", mm.find(b"<HealthData")) + 1
+        bodyEnd = mm.rfind(b"</HealthData>")
+        step = (bodyEnd - bodyStart) // shards
+
+        boundaries = [bodyStart]
+        for shard in range(1, shards):
+            # Health indents the children of HealthData by a single space, nested elements (e.g. MetadataEntry) are indented further,
+            # so a newline followed by " <" (and not a closing tag) marks the start of a top level element
+            position = mm.find(b"\n <", max(bodyStart + shard * step, boundaries[-1]), bodyEnd)
+            while position != -1 and mm[position + 3:position + 4] == b"/":
+                position = mm.find(b"\n <", position + 3, bodyEnd)
+            if position == -1:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+        boundaries.append(bodyEnd)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+# Desc: Worker used by the parallel extraction, collects the records for the data types inside a single byte range of export.xml
+# Input: Tuple of (export.xml path, start offset, end offset, year, output file names of the requested data types, watermarks)
+# Output: Same as collect_records(), for the records within the byte range, and the stage record of the worker (see instrumentation.py)
+def collect_shard(shard):
+    exportFile, start, end, year, outputFileNames, watermarks = shard
+    # the data type dictionaries hold lambdas which can't be pickled, rebuild them inside the worker
+    objectsByName = {object["outputFileName"]: object for object in static_data(year)}
+    objects = [objectsByName[outputFileName] for outputFileName in outputFileNames]
+    with report.stage("collect_shard") as record:
+        results = collect_records(read_shard(exportFile, start, end), objects, watermarks)
+    return results, record
+
+# Desc: Reads a byte range of export.xml (see shard_export()) as a standalone xml document
+# Input: export.xml path, start and end offsets
+# Output: File object that can be passed to iter_records()
+def read_shard(exportFile, start, end):
+    with open(exportFile, "rb") as file:
+        file.seek(start)
+        body = file.read(end - start)
+    return io.BytesIO(b"<HealthData>" + body + b"</HealthData>")
+
+# Desc: Runs a shard worker (collect_shard(), collect_statistics_shard() or catalog_shard()) over every shard, in a pool of worker processes
+#       or, with a single worker, one shard after the other in this process
+# Input: Worker function, list of shard tuples and the number of worker processes
+# Output: Generator of the worker results, in shard order, the stages of the worker processes are added to the run report as children of
+#         the current stage (see add_worker_stage() in instrumentation.py)
+def map_shards(function, shards, workers):
+    if workers <= 1:
+        # the stage of the worker is nested in the current stage, so it is already part of the report
+        for shard in shards:
+            yield function(shard)[0]
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(report.profileStage, [record["name"] for record in report.active])) as executor:
+        for result, record in executor.map(function, shards):
+            report.add_worker_stage(record)
+            yield result
+
+# Desc: Collects the records for every data type using a pool of worker processes, one byte range of export.xml per task
+# Input: export.xml path, list of data type dictionaries (see static_data()), the number of worker processes (1: the byte ranges are
+#        parsed one after the other in this process), optionally the watermarks and the byte ranges to parse (see plan_shards()),
+#        by default the whole file is split into a few byte ranges per worker
+# Output: Same as collect_records(), the shards are merged in file order so the output is identical to the serial path
+def collect_records_parallel(exportFile, objects, workers, watermarks=None, byteRanges=None):
+    years = {object["year"] for object in objects}
+    if len(years) != 1:
+        raise ValueError("Parallel extraction requires all data types to use the same year")
+    year = years.pop()
+    outputFileNames = [object["outputFileName"] for object in objects]
+
+    # use a few shards per worker so a slow shard doesn't leave the other workers idle
+    if byteRanges is None:
+        byteRanges = shard_export(exportFile, workers * 4)
+    shards = [(exportFile, start, end, year, outputFileNames, watermarks) for start, end in byteRanges]
+    results = [new_buffers(object) for object in objects]
+    latestDates = {}
+    for shardResults, shardLatestDates in map_shards(collect_shard, shards, workers):
+        for key, creationDateTime in shardLatestDates.items():
+            if key not in latestDates or creationDateTime > latestDates[key]:
+                latestDates[key] = creationDateTime
+        for buffers, shardBuffers in zip(results, shardResults):
+            for column, values in shardBuffers.items():
+                buffers[column].extend(values)
+
+    return results, latestDates
+
+# Desc: Configuration of the extraction of a data type, part of its stage cache key (see stage_cache.py)
+# Input: Data type dictionary (see static_data())
+# Output: Dictionary
+def extraction_config(object):
+    return {
+        "dataTypeString": object["dataTypeString"],
+        "year": object["year"],
+        "outputFileName": object["outputFileName"],
+        "columns": object["columns"],
+        "valueColumn": object["valueColumn"],
+        "dtype": object["dtype"],
+        "deduplicate": object["deduplicate"],
+        "cumulative": object["cumulative"],
+        # the extraction code, including everything it calls (column buffers, timestamp parsing, source merge, registry, ...)
+        "code": code_fingerprint(data_extract),
+    }
 
-# Desc: Extracts data for each of the data types passed to the function
-# Input: Dictionary containing data type specific information used in extraction process
-# Output: A JSON and a CSV file that contains all of the extracted data for the specified data type and year
-def data_extract(object):
-    # get root from object 
-    root = object["root"]
-    # get date and time variables from the data type object
-    dataTypeString = object["dataTypeString"]
-    year = object["year"]
-    objectParameters = object["objectParameters"]
-    # create output file name string
-    outputFileName = object["outputFileName"]
-
-    data = {}
-    # helper function used for flattening data
-    def data_extract_helper(data, dict_func):
-        return [
-            dict_func(date, obs)
-            for date, observations in data.items()
-            for obs in observations
-        ]
-
-    # iterate through each observation ("Record") in the exported data
-    for child in root:
-        if child.tag == "Record":
-            # extract date/times (measurement creation date, the start date/time of the measurement, and the end date/time of the observantion)
-            creationDate = child.attrib.get("creationDate")[:-15]
-            creationDateTime = child.attrib.get("creationDate")[11:19]
-            startDate = child.attrib.get("startDate")[:-15]
-            startTime = child.attrib.get("startDate")[11:19]
-            endDate = child.attrib.get("endDate")[:-15]
-            endTime = child.attrib.get("endDate")[11:19]
-
-            # calculate the total time the measurement took
-            startTimeFormatted = datetime.strptime(startTime, "%H:%M:%S")
-            endTimeFormatted = datetime.strptime(endTime, "%H:%M:%S")
-            totalTime = str(endTimeFormatted - startTimeFormatted)
-
-
-            # refactor, not all types will use/ have sourceName
-
-            # extract the device name and type, where the measurement was taken
-            source = child.attrib.get("sourceName")
-            if "iPhone" in source:
-                source = "iPhone"
-            elif "Watch" in source:
-                source = "Watch"
+# Desc: Collects the records of a single export
+# Input: Path of an export.xml or export.zip, a list of data type dictionaries (see static_data()), the number of worker processes,
+#        optionally the watermarks and the catalog of export.xml (see build_catalog())
+# Output: Same as collect_records()
+def collect_export(exportFile, objects, workers=1, watermarks=None, catalog=None):
+    if is_archive(exportFile):
+        # a compressed stream can't be split into byte ranges, so export.xml is streamed out of the archive in this process
+        with open_export(exportFile) as file:
+            return collect_records(file, objects, watermarks)
+    if catalog is not None:
+        # data types that are absent from the export (or have no records in the requested year) are written empty without parsing
+        presentObjects = [object for object in objects if catalog_count(catalog, object["dataTypeString"], object["year"])]
+        results, latestDates = collect_records_parallel(exportFile, presentObjects, workers, watermarks, plan_shards(catalog, presentObjects)) if presentObjects else ([], {})
+        presentResults = dict(zip([id(object) for object in presentObjects], results))
+        return [presentResults.get(id(object)) or new_buffers(object) for object in objects], latestDates
+    if workers > 1:
+        return collect_records_parallel(exportFile, objects, workers, watermarks)
+    return collect_records(exportFile, objects, watermarks)
+
+# Desc: Extracts data for each of the data types passed to the function in a single streaming pass over export.xml
+# Input: Path of an export.xml or export.zip (or a list of exports whose records are merged), a list of data type dictionaries
+#        (see static_data()), optionally the number of worker processes, whether to only ingest the records created since the previous
+#        incremental run (per type and year watermark), a StageCache (data types whose output is cached for these exports are restored instead of
+#        extracted) and the catalog of a single export.xml (see build_catalog()), with a catalog only the byte ranges that hold the
+#        requested data types are parsed
+# Output: A typed parquet file per data type that contains all of the extracted data for the specified data type and year
+def data_extract(exportFiles, objects, workers=1, incremental=False, cache=None, catalog=None):
+    if isinstance(exportFiles, str):
+        exportFiles = [exportFiles]
+    watermarks = read_watermarks() if incremental else None
+
+    # the output of an incremental run depends on the previous runs and not only on the exports, so it is never cached
+    pending = [(object, None) for object in objects]
+    if cache is not None and cache.enabled and not incremental:
+        pending = []
+        for object in objects:
+            key = cache.key("data_extract", exportFiles, extraction_config(object))
+            if not cache.restore(key, [parquet_path(object["outputFileName"], object["year"])]):
+                pending.append((object, key))
+        if not pending:
+            # every data type was restored, export.xml isn't parsed at all
+            return
+
+    pendingObjects = [object for object, key in pending]
+    with report.stage("collect_records"):
+        results = None
+        latestDates = {}
+        for index, exportFile in enumerate(exportFiles):
+            exportResults, exportLatestDates = collect_export(exportFile, pendingObjects, workers, watermarks, catalog if len(exportFiles) == 1 else None)
+            if len(exportFiles) > 1:
+                # every record keeps the index of the export it was read from (see write_data_type())
+                for buffers in exportResults:
+                    buffers["export"] = constant_column(index, len(buffers["date"]))
+            if results is None:
+                results = exportResults
             else:
-                source = "Other"
-
-            device = child.attrib.get("device")
-            if device != None:
-                start = device.find("name:") + len("name:")
-                end = device.find(",", start)
-                device = device[start:end].strip()
-
-            # extract the unit from the measurement observation
-            unit = child.attrib.get("unit") or ""
-
-            # if the record is the same type as the object passed and the year matches the object defined year, add the following to the output json object:
-            if child.attrib.get("type") == dataTypeString and creationDate[0:4] == year:
-                args = (child, creationDateTime)
-                if "startTime" != None:
-                    args += (startTime,)
-                if "endTime" != None:
-                    args += (endTime,)
-                if "totalTime" != None:
-                    args += (totalTime,)
-                if "source" != None:
-                    args += (source,)
-                if "unit" != None:
-                    args += (unit,)
-                if "device" != None:
-                    args += (device,)
-
-                # concatinate the arguments from above into a single object
-                objectParameters = object["objectParameters"](*args)
-
-                # if the creation date is a key in the output object, add the objectParameters object to that key-value pair, 
-                # else create an item in the output object where the creation date is the key and the value contains the objectParameters object
-                if creationDate in data.keys():
-                    data[creationDate].append(objectParameters)
-                else:
-                    data[creationDate] = [objectParameters]
-
-
-    if not os.path.exists("../data/json"):
-        os.makedirs("../data/json")
-    if not os.path.exists("../data/csv"):
-        os.makedirs("../data/csv")
-
-    outputFileJSON = "../data/json/" +outputFileName + ".json"
-    with open(outputFileJSON, "w") as file:
-        json.dump(data, file)
-
-    # flatten data observations per date
-    flatData = data_extract_helper(data, lambda date, obs: {
-        'date': date,
-        **obs
-    })
-
-    df = pd.DataFrame(flatData)
-    outputFileCSV = "../data/csv/" + outputFileName + ".csv"
-    df.to_csv(outputFileCSV)
+                for buffers, exportBuffers in zip(results, exportResults):
+                    for column, buffer in buffers.items():
+                        buffer.extend(exportBuffers[column])
+            for key, latestDate in exportLatestDates.items():
+                latestDates[key] = max(latestDate, latestDates.get(key, latestDate))
+    for (object, key), data in zip(pending, results):
+        with report.stage("write_data_type", object["dataTypeString"]):
+            write_data_type(object, data, append=incremental, watermark=(watermarks or {}).get((object["dataTypeString"], object["year"])))
+            if key is not None:
+                cache.store(key, [parquet_path(object["outputFileName"], object["year"])])
+
+    if incremental:
+        # the watermark only moves forward once the new records are written
+        watermarks.update(latestDates)
+        write_watermarks(watermarks)
+
+# Desc: Extracts the electrocardiograms and workout routes of export.zip files, the files are parsed in batches by a pool of worker
+#       processes (see archive.py)
+# Input: List of export.zip paths, the year to extract (YYYY) and the number of worker processes
+# Output: A typed parquet file per kind of attachment (see ATTACHMENTS in archive.py) for the specified year
+def attachments_extract(exportFiles, year, workers=1):
+    for outputFileName, folder, extension, worker in ATTACHMENTS:
+        with report.stage("attachments_extract", outputFileName):
+            shards = []
+            parsed = set()
+            for exportFile in exportFiles:
+                # a file already found in a previous export (e.g. two exports of the same account) is only parsed once
+                members = [member for member in archive_members(exportFile, folder, extension) if os.path.basename(member) not in parsed]
+                parsed.update(os.path.basename(member) for member in members)
+                shards += [(exportFile, members[index:index + BATCH_SIZE]) for index in range(0, len(members), BATCH_SIZE)]
+            # an empty batch builds the empty typed frame, so the output is written even if no export holds any of these files
+            frames = list(map_shards(worker, shards or [(exportFiles[0], [])], workers))
+            df = pd.concat(frames, ignore_index=True)
+            # batches with different categories are concatenated as strings
+            for column in frames[0].select_dtypes("category").columns:
+                df[column] = df[column].astype("category")
+            df = df[df["date"].dt.year == int(year)].reset_index(drop=True)
+            report.count(recordsMatched=len(df))
+            write_data_frame(df, outputFileName, year)
+
+# Desc: Computes per (data type, time bucket) statistics while streaming export.xml, without keeping the records in memory
+# Input: export.xml path (or file object), a list of data type dictionaries (see static_data()), the bucket size (see online_statistics.py)
+#        and the number of records per type that are converted and folded into the accumulators at once
+# Output: OnlineStatistics, keyed by dataTypeString and the local start time of the bucket
+def collect_statistics(exportFile, objects, bucket="hour", batchSize=100000):
+    statistics = OnlineStatistics(bucket)
+    years = {}
+    for object in objects:
+        years.setdefault(object["dataTypeString"], set()).add(object["year"])
+
+    # flush a batch of raw start dates and values: convert them in bulk and update the accumulators
+    def flush(dataTypeString, batch):
+        startDates, values = batch
+        epochSeconds, utcOffsets = parse_timestamps(startDates)
+        numericValues = pd.to_numeric(pd.Series(values, dtype="object"), errors="coerce").to_numpy(dtype=np.float64)
+        valid = ~np.isnan(numericValues)
+        statistics.update(dataTypeString, epochSeconds[valid], utcOffsets[valid], numericValues[valid])
+        startDates.clear()
+        values.clear()
+
+    batches = {}
+    for child in iter_records(exportFile):
+        # filter on type and year before doing any other parsing
+        dataTypeString = child.attrib.get("type")
+        typeYears = years.get(dataTypeString)
+        if typeYears is None or child.attrib.get("creationDate")[0:4] not in typeYears:
+            continue
+
+        batch = batches.setdefault(dataTypeString, ([], []))
+        batch[0].append(child.attrib.get("startDate"))
+        batch[1].append(child.attrib.get("value"))
+        if len(batch[0]) >= batchSize:
+            flush(dataTypeString, batch)
+
+    for dataTypeString, batch in batches.items():
+        if batch[0]:
+            flush(dataTypeString, batch)
+    return statistics
+
+# Desc: Worker used by the parallel online statistics, computes the statistics of a single byte range of export.xml
+# Input: Tuple of (export.xml path, start offset, end offset, year, output file names of the requested data types, bucket size)
+# Output: OnlineStatistics of the byte range and the stage record of the worker (see instrumentation.py)
+def collect_statistics_shard(shard):
+    exportFile, start, end, year, outputFileNames, bucket = shard
+    objects = [object for object in static_data(year) if object["outputFileName"] in outputFileNames]
+    with report.stage("collect_statistics_shard") as record:
+        statistics = collect_statistics(read_shard(exportFile, start, end), objects, bucket)
+    return statistics, record
+
+# Desc: Computes the online statistics of every data type, optionally split across a pool of worker processes
+# Input: export.xml (or export.zip) path, list of data type dictionaries (see static_data()), bucket size, the number of worker processes
+#        and optionally the catalog of export.xml (see build_catalog()), with a catalog only the byte ranges that hold the requested data
+#        types are parsed
+# Output: OnlineStatistics, the partial results of every shard are merged
+def online_statistics(exportFile, objects, bucket="hour", workers=1, catalog=None):
+    if is_archive(exportFile):
+        # a compressed stream can't be split into byte ranges
+        with open_export(exportFile) as file:
+            return collect_statistics(file, objects, bucket)
+    if workers <= 1 and catalog is None:
+        return collect_statistics(exportFile, objects, bucket)
+
+    year = objects[0]["year"]
+    outputFileNames = [object["outputFileName"] for object in objects]
+    byteRanges = plan_shards(catalog, objects) if catalog is not None else shard_export(exportFile, workers * 4)
+    shards = [(exportFile, start, end, year, outputFileNames, bucket) for start, end in byteRanges]
+    statistics = OnlineStatistics(bucket)
+    for shardStatistics in map_shards(collect_statistics_shard, shards, workers):
+        statistics.merge(shardStatistics)
+    return statistics
 
 # Desc: Creates a file that contains a subset of the original data type file (three days worth of data)
-# Input: Data type specific file, generated from data_extract()
+# Input: Output file name and year of a data type, generated from data_extract()
 # Output: File containing a subset of the original file (first three days of data, unless specified by the optional days argument)
-def three_days_data(file, days=None):
-    data = []
-    firstThreeDates = []
-    outputData = []
-    header = ""
-    # open file and extract each line into a sub list of data
-    with open(file, "r") as file:
-        header = file.readline()
-        for observation in file:
-            data.append(observation)
-    
+def three_days_data(outputFileName, year, days=None):
+    df = read_data_type(outputFileName, year)
+
     if days == None:
         # extract the first three dates from the file
-        for observation in data:
-            observation = observation.split(",")
-            if len(firstThreeDates) >= 3:
-                break
-            else:
-                if observation[1] not in firstThreeDates:
-                    firstThreeDates.append(observation[1])
+        firstThreeDates = list(df["date"].unique()[:3])
     else:
         firstThreeDates = days
 
-    # remove the first item from the firstThreeDates -- can refactor
-    if 'date' in firstThreeDates:
-        firstThreeDates.remove('date')
-
     # extract the observations that occur on the firstThreeDates
-    for observation in data:
-        observation = observation.split(",")
-        if observation[1] in firstThreeDates:
-            outputData.append(observation)
-
-    # remove newline character from any data point in each observation
-    for obs in outputData:
-        for index, item in enumerate(obs):
-            if '\n' in item:
-                obs[index] = item.replace('\n','')
-    
-    # clean header
-    header = header.split(',')
-    for index,item in enumerate(header):
-        if '\n' in item:
-            header[index] = item.replace('\n', '') 
-
-    outputDf = pd.DataFrame(outputData, columns=header)
-    dir, fileName = os.path.split(file.name)
-    outputfilename= "three_days_" + fileName
-    outputfilepath = os.path.join(dir, outputfilename)
-    
-    outputDf.to_csv(outputfilepath)
+    outputDf = df[df["date"].isin(firstThreeDates)]
+    write_data_frame(outputDf, "three_days_" + outputFileName, year)
     return firstThreeDates
 
 
 
+# Desc: Builds the catalog entries of the records within a single byte range of export.xml
+# Input: Tuple of (export.xml path, start offset, end offset)
+# Output: Dictionary of type -> entry (count, per year counts, units, sources and the earliest start / latest end as (epoch seconds, raw
+#         timestamp) tuples) and the stage record of the shard (see instrumentation.py)
+def catalog_shard(shard):
+    exportFile, start, end = shard
+    types = {}
+    # raw start and end dates per type, converted in bulk (see parse_timestamps()) to keep the earliest start and latest end
+    batches = {}
+
+    def flush(entry, batch):
+        for dates, position, key, better in ((batch[0], np.argmin, "firstStart", lambda new, old: new < old), (batch[1], np.argmax, "lastEnd", lambda new, old: new > old)):
+            epochSeconds, utcOffsets = parse_timestamps(dates)
+            index = position(epochSeconds)
+            if entry[key] is None or better(int(epochSeconds[index]), entry[key][0]):
+                entry[key] = (int(epochSeconds[index]), dates[index])
+            dates.clear()
+
+    with report.stage("catalog_shard") as record:
+        for child in iter_records(read_shard(exportFile, start, end)):
+            attributes = child.attrib
+            dataTypeString = attributes.get("type", WORKOUT_TYPE)
+            entry = types.get(dataTypeString)
+            if entry is None:
+                entry = types[dataTypeString] = {"count": 0, "years": Counter(), "units": Counter(), "sources": Counter(), "firstStart": None, "lastEnd": None}
+                batches[dataTypeString] = ([], [])
+            entry["count"] += 1
+            entry["years"][attributes.get("creationDate")[0:4]] += 1
+            entry["sources"][attributes.get("sourceName")] += 1
+            unit = attributes.get("unit")
+            if unit is not None:
+                entry["units"][unit] += 1
+
+            batch = batches[dataTypeString]
+            batch[0].append(attributes.get("startDate"))
+            batch[1].append(attributes.get("endDate"))
+            if len(batch[0]) >= 100000:
+                flush(entry, batch)
+
+        for dataTypeString, batch in batches.items():
+            if batch[0]:
+                flush(types[dataTypeString], batch)
+    return types, record
+
+# Desc: Path of the catalog of an export, the catalog is stored next to export.xml
+# Input: export.xml path
+# Output: Path of the catalog json file
+def catalog_path(exportFile):
+    return os.path.join(os.path.dirname(os.path.abspath(exportFile)), "export_catalog.json")
+
+# Desc: Builds the catalog of export.xml in a single pass: per type record counts (per creation year), earliest start and latest end,
+#       units and sources, and for every byte range of the file the types (and years) it holds, so later runs can skip absent types and
+#       only parse the byte ranges that hold the requested types (see plan_shards())
+# Input: export.xml path, the number of worker processes and the approximate size of a byte range in bytes
+# Output: Catalog dictionary, also written to catalog_path()
+def build_catalog(exportFile, workers=1, shardBytes=16 * 2**20):
+    byteRanges = shard_export(exportFile, max(1, math.ceil(os.path.getsize(exportFile) / shardBytes)))
+    shards = [(exportFile, start, end) for start, end in byteRanges]
+
+    types = {}
+    catalogShards = []
+    for (start, end), shardTypes in zip(byteRanges, map_shards(catalog_shard, shards, workers)):
+        catalogShards.append({
+            "start": start,
+            "end": end,
+            "records": sum(entry["count"] for entry in shardTypes.values()),
+            "types": {dataTypeString: dict(entry["years"]) for dataTypeString, entry in shardTypes.items()},
+        })
+        for dataTypeString, entry in shardTypes.items():
+            total = types.get(dataTypeString)
+            if total is None:
+                types[dataTypeString] = entry
+                continue
+            total["count"] += entry["count"]
+            for counter in ("years", "units", "sources"):
+                total[counter].update(entry[counter])
+            if entry["firstStart"][0] < total["firstStart"][0]:
+                total["firstStart"] = entry["firstStart"]
+            if entry["lastEnd"][0] > total["lastEnd"][0]:
+                total["lastEnd"] = entry["lastEnd"]
+
+    stat = os.stat(exportFile)
+    catalog = {
+        "exportFile": os.path.abspath(exportFile),
+        "size": stat.st_size,
+        "mtimeNs": stat.st_mtime_ns,
+        "records": sum(entry["count"] for entry in types.values()),
+        "types": {
+            dataTypeString: {
+                "count": entry["count"],
+                "years": dict(sorted(entry["years"].items())),
+                "firstStart": entry["firstStart"][1],
+                "lastEnd": entry["lastEnd"][1],
+                "units": dict(entry["units"].most_common()),
+                "sources": dict(entry["sources"].most_common()),
+            }
+            for dataTypeString, entry in sorted(types.items())
+        },
+        "shards": catalogShards,
+    }
+    with open(catalog_path(exportFile), "w") as file:
+        json.dump(catalog, file, indent=4)
+    report.count(bytesWritten=os.path.getsize(catalog_path(exportFile)))
+    return catalog
+
+# Desc: Reads the catalog of export.xml written by build_catalog()
+# Input: export.xml path
+# Output: Catalog dictionary, None if there is no catalog or export.xml changed since it was built
+def read_catalog(exportFile):
+    if not os.path.exists(catalog_path(exportFile)):
+        return None
+    with open(catalog_path(exportFile), "r") as file:
+        catalog = json.load(file)
+    stat = os.stat(exportFile)
+    if catalog["size"] != stat.st_size or catalog["mtimeNs"] != stat.st_mtime_ns:
+        return None
+    return catalog
+
+# Desc: Number of records of a type created in a year, according to the catalog
+# Input: Catalog dictionary, dataTypeString and year (YYYY)
+# Output: Record count
+def catalog_count(catalog, dataTypeString, year):
+    return catalog["types"].get(dataTypeString, {}).get("years", {}).get(year, 0)
+
+# Desc: Selects the byte ranges of export.xml that hold records of the requested data types
+# Input: Catalog dictionary and a list of data type dictionaries (see static_data())
+# Output: List of (start, end) byte offsets, in file order
+def plan_shards(catalog, objects):
+    requested = {(object["dataTypeString"], object["year"]) for object in objects}
+    return [
+        (shard["start"], shard["end"])
+        for shard in catalog["shards"]
+        if any(shard["types"].get(dataTypeString, {}).get(year) for dataTypeString, year in requested)
+    ]
+
 # Ouput/Desc: txt file that contains a list of all available data types from health app export.xml
-def extract_data_types(root):
+def extract_data_types(exportFile, workers=1):
+    # the types are listed in the catalog, which is only built if export.xml changed since the last one
+    catalog = read_catalog(exportFile) or build_catalog(exportFile, workers)
     dataTypes = []
-    uniqueTypes = []
-    # iterate thru each record in export.xml
-    for child in root:
-        if child.tag == "Record":
-            # if the datatype name is not already in the uniqueTypes list, append it
-            if child.attrib.get("type") not in uniqueTypes:
-                uniqueTypes.append(child.attrib.get("type"))
     # strip off the apple prefix to get a clean datatype name
-    for item in uniqueTypes:
-        if "HKQuantityTypeIdentifier" in item:
-            dataItem = item.replace("HKQuantityTypeIdentifier", "")
-            if dataItem not in dataTypes:
-                dataTypes.append(dataItem)
-        elif "HKCategoryTypeIdentifier" in item:
-            dataItem = item.replace("HKCategoryTypeIdentifier", "")
-            if dataItem not in dataTypes:
-                dataTypes.append(dataItem)
+    for item in catalog["types"]:
+        dataItem = item.replace("HKQuantityTypeIdentifier", "").replace("HKCategoryTypeIdentifier", "")
+        if dataItem != item and dataItem not in dataTypes:
+            dataTypes.append(dataItem)
     # write the datatypes to a file
     with open("dataTypes.txt", "w") as file:
         for item in dataTypes:
             file.write(item + ", ")
 
-# Desc: Static dictionaries for each data type
-def static_data(root, year):
-    # each dictionary has a unique set of key value pairs that are used to search for, and extract, the corresponding data from the export.xml file.
-        # each dictionary specifies the name of the specific datatype output file
-    heartRate = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierHeartRate",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None, device=None: {
-            "heartRate": child.attrib.get("value"),
-            "time": creationDateTime,
-        },
-        "outputFileName": "heart_rate_data",
-    }
-    restingHeartRate = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierRestingHeartRate",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None,
-        device=None:{
-            "heartRate": child.attrib.get("value"),
-            "time": creationDateTime,
-        },
-        "outputFileName": "resting_heart_rate_data",
-    }
-    heartRateVariability = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierHeartRateVariabilitySDNN",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None, device=None: {
-            "heartRateVariability": child.attrib.get("value"),
-            "time": creationDateTime,
-        },
-        "outputFileName": "heart_rate_variability_data",
-    }
-    steps = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierStepCount",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None, device=None: {
-            "startTime": startTime,
-            "endTime": endTime,
-            "totalTime": str(totalTime),
-            "steps": child.attrib.get("value"),
-            "source": source,
-        },
-        "outputFileName": "steps_data",
-    }
-    walkingStepLength = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierWalkingStepLength",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None, device=None: {
-            "startTime": startTime,
-            "endTime": endTime,
-            "totalTime": str(totalTime),
-            "gaitLength": child.attrib.get("value"),
-            "unit": unit,
-            "source": source,
-        },
-        "outputFileName": "gait_length_data"
-    }
-    envAudioExposure = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierEnvironmentalAudioExposure",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None, device=None: {
-            "startTime": startTime,
-            "endTime": endTime,
-            "totalTime": str(totalTime),
-            "environmentalAudioExposure": child.attrib.get("value"),
-            "unit": child.attrib.get("unit"),
-            "device": device,
-        },
-        "outputFileName": "environmental_audio_exposure_data",
-    }
-    headphoneAudioExposure = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierHeadphoneAudioExposure",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None, device=None: {
-            "startTime": startTime,
-            "endTime": endTime,
-            "totalTime": str(totalTime),
-            "headphoneAudioExposure": child.attrib.get("value"),
-            "unit": child.attrib.get("unit"),
-            "device": device,
-        },
-        "outputFileName": "headphone_audio_exposure_data",
-    }
-    timeInDaylight = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierTimeInDaylight",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None, device=None: {
-            "startTime": startTime,
-            "endTime": endTime,
-            "totalTime": str(totalTime),
-            "timeInDayLightValue": child.attrib.get("value"),
-            "unit": unit,
-        },
-        "outputFileName": "time_in_daylight_data",
-    }
-    spo2 = {
-        "root": root,
-        "dataTypeString": "HKQuantityTypeIdentifierOxygenSaturation",
-        "year": year,
-        "objectParameters": lambda child, creationDateTime, startTime=None, endTime=None, totalTime=None, source=None, unit=None,
-        device=None: {
-            "startTime": startTime,
-            "endTime": endTime,
-            "totalTime": totalTime,
-            "SpO2": child.attrib.get("value"),
-            "source": source,
-            "unit": unit,
-        },
-        "outputFileName": "spo2_data"
-    }
-
-    return heartRate, restingHeartRate, heartRateVariability, steps, walkingStepLength, envAudioExposure, headphoneAudioExposure, timeInDaylight, spo2
+# Desc: Data type dictionaries of every type in the registry (see data_types.py)
+# Input: Year to extract (YYYY)
+# Output: List of dictionaries, each holds the registry entry (dataTypeString, columns, valueColumn, dtype, unit, outputFileName,
+#         cumulative, deduplicate) and the year
+def static_data(year):
+    return [dict(dataType, year=year) for dataType in DATA_TYPES]
 
 
-def main():
+def main(workers=1, incremental=False, onlineStatistics=False, cache=StageCache(enabled=False), buildCatalog=False, deduplicate=True, exportFiles=None):
 
-    # get export.xml tree root
-    tree = ET.parse("../../apple_health_export_data/apple_health_export/export.xml")
-    root = tree.getroot()
+    # path to the export.xml file, the file is streamed so it is never loaded into memory as a whole
+    exportFile = "../../apple_health_export_data/apple_health_export/export.xml"
+    # or the export.zip file(s) written by the Health app (see --export), read without extracting them to disk
+    exportFiles = exportFiles or [exportFile]
+    archives = [exportFile for exportFile in exportFiles if is_archive(exportFile)]
 
     # To extract data from a different year please replace this with the desired year, format must be YYYY
     year = "2023"
 
-    (
-        heartRate, 
-        restingHeartRate,
-        heartRateVariability, 
-        steps,
-        walkingStepLength,
-        envAudioExposure, 
-        headphoneAudioExposure, 
-        timeInDaylight,
-        spo2
-        ) = static_data(root, year)
-    data_extract(heartRate)
-    data_extract(restingHeartRate)
-    data_extract(heartRateVariability)
-    data_extract(steps)
-    data_extract(walkingStepLength)
-    data_extract(envAudioExposure)
-    data_extract(headphoneAudioExposure)
-    data_extract(timeInDaylight)
-    data_extract(spo2)
+    # the catalog (see build_catalog()) lets the extraction skip absent data types and the byte ranges that don't hold the requested ones,
+    # it is built from the byte offsets of a single (uncompressed) export.xml
+    catalog = None
+    if len(exportFiles) == 1 and not archives:
+        if buildCatalog:
+            with report.stage("build_catalog"):
+                build_catalog(exportFiles[0], workers)
+        catalog = read_catalog(exportFiles[0])
+
+    objects = static_data(year)
+    if not deduplicate:
+        # keep every sample of every source, as stored by the Health app
+        for object in objects:
+            object["deduplicate"] = False
+    # the statistics, the query store and the correlations only cover the types with numeric values
+    quantityObjects = [object for object in objects if object["kind"] == "quantity"]
+
+    if onlineStatistics:
+        # bounded memory mode: only the per hour accumulators are kept, the records themselves are never stored
+        os.makedirs("../data/descriptive_statistics", exist_ok=True)
+        with report.stage("online_statistics"):
+            statistics = OnlineStatistics("hour")
+            for exportFile in exportFiles:
+                statistics.merge(online_statistics(exportFile, quantityObjects, "hour", workers, catalog))
+            statistics.save("../data/descriptive_statistics/online_hourly_statistics_state.json")
+            report.count(bytesWritten=os.path.getsize("../data/descriptive_statistics/online_hourly_statistics_state.json"))
+            write_csv(statistics.to_frame(), "../data/descriptive_statistics/online_hourly_statistics.csv")
+        return
+
+    # extract every data type in a single pass over export.xml (split across worker processes if workers > 1)
+    # in incremental mode only the records created since the previous run are appended to the existing files
+    with report.stage("data_extract"):
+        data_extract(exportFiles, objects, workers, incremental, cache, catalog)
+
+    # the electrocardiograms and workout routes are only part of export.zip, thousands of small files parsed by a pool of workers
+    if archives:
+        with report.stage("attachments"):
+            cache.run(
+                "attachments",
+                archives,
+                {"year": year, "code": code_fingerprint(attachments_extract)},
+                [parquet_path(outputFileName, year) for outputFileName, folder, extension, worker in ATTACHMENTS],
+                lambda: attachments_extract(archives, year, workers),
+            )
+
+    # load the extracted data into the indexed query store used for time range lookups (see query_store.py)
+    with report.stage("load_query_store"), QueryStore() as store:
+        for object in quantityObjects:
+            with report.stage("load_data_type", object["dataTypeString"]):
+                store.load_data_type(object["dataTypeString"], read_data_type(object["outputFileName"], year), object["unit"])
+
+    # minute, hour, day and week rollups of the full history of every metric, read by the notebook through downsample() (see rollups.py)
+    with report.stage("rollups"):
+        for object in quantityObjects:
+            with report.stage("build_rollups", object["dataTypeString"]):
+                cache.run(
+                    "rollups",
+                    partition_paths(object["outputFileName"]),
+                    {"outputFileName": object["outputFileName"], "valueColumn": object["valueColumn"], "code": code_fingerprint(build_rollups)},
+                    [rollup_path(object["outputFileName"], resolution) for resolution in RESOLUTIONS],
+                    lambda: build_rollups(object),
+                )
 
     # get the first three dates available in the hear rate file and use as the dates to extract for the remaining files
-    firstThreeDates = three_days_data("../data/csv/heart_rate_data.csv")
-    three_days_data('../data/csv/steps_data.csv', firstThreeDates)
-    three_days_data('../data/csv/spo2_data.csv',firstThreeDates)
-    three_days_data('../data/csv/gait_length_data.csv',firstThreeDates)
+    # every subset is cached, keyed by the extracted file it is taken from and the dates
+    with report.stage("three_days_data"):
+        firstThreeDates = None
+        for outputFileName in ["heart_rate_data", "steps_data", "spo2_data", "gait_length_data"]:
+            cache.run(
+                "three_days_data",
+                [parquet_path(outputFileName, year)],
+                {"outputFileName": outputFileName, "year": year, "days": firstThreeDates, "code": code_fingerprint(three_days_data)},
+                [parquet_path("three_days_" + outputFileName, year)],
+                lambda: three_days_data(outputFileName, year, firstThreeDates),
+            )
+            if firstThreeDates is None:
+                # the heart rate subset holds exactly the first three dates, whether it was computed or restored
+                firstThreeDates = list(read_data_type("three_days_heart_rate_data", year, columns=["date"])["date"].unique())
 
     statisticalTestInstance = StatisticalTest(
-            heartRateFile="../data/csv/three_days_heart_rate_data.csv", 
-            stepsFile="../data/csv/three_days_steps_data.csv",
-            gaitFile="../data/csv/three_days_gait_length_data.csv",
-            spo2File="../data/csv/three_days_spo2_data.csv"
+            heartRateFile=parquet_path("three_days_heart_rate_data", year),
+            stepsFile=parquet_path("three_days_steps_data", year),
+            gaitFile=parquet_path("three_days_gait_length_data", year),
+            spo2File=parquet_path("three_days_spo2_data", year)
+        )
+
+    with report.stage("descriptive_statistics"):
+        cache.run(
+            "descriptive_statistics",
+            [statisticalTestInstance.heartRateFile, statisticalTestInstance.stepsFile, statisticalTestInstance.gaitFile, statisticalTestInstance.spo2File],
+            {"code": code_fingerprint(StatisticalTest)},
+            list(DESCRIPTIVE_STATISTICS_FILES.values()),
+            statisticalTestInstance.descriptive_statistics,
         )
 
-    statisticalTestInstance.descriptive_statistics()
+    # aggregate every extracted metric over the full year in a single pass
+    with report.stage("aggregate"):
+        with QueryStore() as store:
+            records = store.query([object["dataTypeString"] for object in quantityObjects])
+        hourlyAggregates = statisticalTestInstance.aggregate(records, bucket="hour")
+        write_csv(hourlyAggregates, "../data/descriptive_statistics/hourly_aggregates.csv")
+
+    # Pearson/Spearman correlations between every pair of metrics, for lags of up to three hours
+    with report.stage("correlations"):
+        correlations = statisticalTestInstance.correlations(hourlyAggregates, lags=range(-3, 4), workers=workers)
+        write_csv(correlations, "../data/descriptive_statistics/correlations.csv")
+
+    # heart rate, HRV and SpO2 split by the workout, mindful session or sleep stage they were measured in (or rest)
+    with report.stage("context_statistics"):
+        with QueryStore() as store:
+            records = store.query(CONTEXT_METRICS)
+        records = join_contexts(records, "start", read_contexts(year))
+        contextStatistics = statisticalTestInstance.context_statistics(records)
+        write_csv(contextStatistics, "../data/descriptive_statistics/context_statistics.csv")
 
     # uncomment if you would like to create a file to see all available data types in
-    # extract_data_types(root)
+    # extract_data_types(exportFile)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract Apple Health data types from export.xml and compute descriptive statistics")
+    parser.add_argument("--export", nargs="+", default=None, help="export.zip file(s) written by the Health app (or export.xml files) to ingest, read without extracting them to disk, several exports are merged (default: the unzipped export.xml in apple_health_export_data)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes used to parse export.xml (default: 1, serial)")
+    parser.add_argument("--incremental", action="store_true", help="only ingest records created since the previous incremental run and append them to the existing files")
+    parser.add_argument("--online-statistics", action="store_true", help="only compute hourly statistics while streaming export.xml, with memory independent of the number of records")
+    parser.add_argument("--report", default="../data/reports/run_report.json", help="path of the JSON run report with the time, memory and counters of every stage (default: ../data/reports/run_report.json)")
+    parser.add_argument("--catalog", action="store_true", help="(re)build the catalog of export.xml (record counts, date ranges, units and sources per type) before extracting, later runs reuse it until export.xml changes")
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse (or store) the cached output of the extraction, rollups, three days subset and descriptive statistics stages")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES // 2**20, help=f"size of the stage cache in MiB, the least recently used entries are evicted (default: {DEFAULT_MAX_BYTES // 2**20})")
+    parser.add_argument("--keep-duplicates", action="store_true", help="keep the samples of every source instead of counting periods recorded by both the iPhone and the Watch once (by source priority: Watch, iPhone, Other)")
+    parser.add_argument("--profile-stage", default=None, help="profile every occurrence of this stage (e.g. collect_records) with cProfile, the dump is written next to the report")
+    args = parser.parse_args()
+
+    if args.profile_stage:
+        report.profile(args.profile_stage)
+
     start = time.time()
-    main()
+    cache = StageCache(maxBytes=args.cache_size * 2**20, enabled=not args.no_cache)
+    main(workers=args.workers, incremental=args.incremental, onlineStatistics=args.online_statistics, cache=cache, buildCatalog=args.catalog, deduplicate=not args.keep_duplicates, exportFiles=args.export)
     end = time.time()
+    report.write(args.report)
     print(f"Runtime: {end-start}")
@@ -0,0 +1,232 @@
+import json
+import math
+import numpy as np
+import pandas as pd
+
+# bucket sizes in seconds supported by OnlineStatistics (same names as StatisticalTest.aggregate())
+BUCKET_SECONDS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+}
+
+
+class QuantileSketch:
+    # Desc: Mergeable quantile sketch with logarithmic bins (DDSketch), every quantile is within relativeAccuracy of the exact value
+    def __init__(self, relativeAccuracy=0.01) -> None:
+        self.relativeAccuracy = relativeAccuracy
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self.logGamma = math.log(self.gamma)
+        # bin index -> count, separately for positive and negative values
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+
+    # Desc: Adds a batch of values to the sketch
+    # Input: numpy array of values
+    # Output: None
+    def update(self, values):
+        self.zeros += int((values == 0).sum())
+        for bins, selected in ((self.positive, values[values > 0]), (self.negative, -values[values < 0])):
+            if selected.size:
+                keys, counts = np.unique(np.ceil(np.log(selected) / self.logGamma).astype(np.int64), return_counts=True)
+                for key, count in zip(keys.tolist(), counts.tolist()):
+                    bins[key] = bins.get(key, 0) + count
+
+    # Desc: Adds the counts of another sketch (with the same relative accuracy) to this sketch
+    def merge(self, other):
+        self.zeros += other.zeros
+        for bins, otherBins in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in otherBins.items():
+                bins[key] = bins.get(key, 0) + count
+
+    # Desc: Estimates a quantile
+    # Input: Quantile between 0 and 1
+    # Output: Estimated value (nan if the sketch is empty)
+    def quantile(self, quantile):
+        total = self.zeros + sum(self.positive.values()) + sum(self.negative.values())
+        if total == 0:
+            return math.nan
+        rank = quantile * (total - 1)
+
+        # walk the bins in increasing value order: negative (largest magnitude first), zeros, positive
+        cumulative = 0
+        for key in sorted(self.negative, reverse=True):
+            cumulative += self.negative[key]
+            if cumulative > rank:
+                return -self.bin_value(key)
+        cumulative += self.zeros
+        if cumulative > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            cumulative += self.positive[key]
+            if cumulative > rank:
+                return self.bin_value(key)
+        return self.bin_value(max(self.positive))
+
+    def bin_value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def to_dict(self):
+        return {
+            "relativeAccuracy": self.relativeAccuracy,
+            "positive": self.positive,
+            "negative": self.negative,
+            "zeros": self.zeros,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["relativeAccuracy"])
+        sketch.positive = {int(key): count for key, count in state["positive"].items()}
+        sketch.negative = {int(key): count for key, count in state["negative"].items()}
+        sketch.zeros = state["zeros"]
+        return sketch
+
+
+class RunningStatistics:
+    # Desc: Count, mean and variance (Welford/Chan), min, max and a quantile sketch of a stream of values
+    def __init__(self, relativeAccuracy=0.01) -> None:
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = QuantileSketch(relativeAccuracy)
+
+    # Desc: Adds a batch of values, the batch is summarised with numpy and combined with the running state
+    # Input: numpy array of values
+    # Output: None
+    def update(self, values):
+        if values.size == 0:
+            return
+        batchMean = float(values.mean())
+        self.combine(values.size, batchMean, float(((values - batchMean) ** 2).sum()), float(values.min()), float(values.max()))
+        self.sketch.update(values)
+
+    # Desc: Adds the state of another accumulator (e.g. from another shard or run)
+    def merge(self, other):
+        if other.count:
+            self.combine(other.count, other.mean, other.m2, other.min, other.max)
+            self.sketch.merge(other.sketch)
+
+    # Desc: Chan et al. pairwise combination of two (count, mean, M2) states
+    def combine(self, count, mean, m2, minimum, maximum):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+
+    @property
+    def sd(self):
+        # sample standard deviation, same as pandas' std()
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "min": self.min,
+            "max": self.max,
+            "sketch": self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        statistics = cls()
+        statistics.count = state["count"]
+        statistics.mean = state["mean"]
+        statistics.m2 = state["m2"]
+        statistics.min = state["min"]
+        statistics.max = state["max"]
+        statistics.sketch = QuantileSketch.from_dict(state["sketch"])
+        return statistics
+
+
+class OnlineStatistics:
+    # Desc: Per (metric, time bucket) running statistics with memory independent of the number of records
+    def __init__(self, bucket="hour", relativeAccuracy=0.01) -> None:
+        if bucket not in BUCKET_SECONDS:
+            raise ValueError(f"Unknown bucket '{bucket}', expected one of {list(BUCKET_SECONDS)}")
+        self.bucket = bucket
+        self.relativeAccuracy = relativeAccuracy
+        # (metric, local bucket start in epoch seconds) -> RunningStatistics
+        self.accumulators = {}
+
+    # Desc: Adds a batch of observations of a single metric
+    # Input: Metric name, numpy arrays of epoch seconds (UTC), timezone offsets in minutes and values
+    # Output: None
+    def update(self, metric, epochSeconds, utcOffsets, values):
+        values = np.asarray(values, dtype=np.float64)
+        localSeconds = np.asarray(epochSeconds, dtype=np.int64) + np.asarray(utcOffsets, dtype=np.int64) * 60
+        if self.bucket == "week":
+            # the epoch is a Thursday, shift so weeks start on Monday
+            days = localSeconds // 86400
+            buckets = (days - (days + 3) % 7) * 86400
+        else:
+            bucketSeconds = BUCKET_SECONDS[self.bucket]
+            buckets = localSeconds // bucketSeconds * bucketSeconds
+
+        order = np.argsort(buckets, kind="stable")
+        buckets, values = buckets[order], values[order]
+        keys, starts = np.unique(buckets, return_index=True)
+        for key, batch in zip(keys.tolist(), np.split(values, starts[1:])):
+            accumulator = self.accumulators.get((metric, key))
+            if accumulator is None:
+                accumulator = self.accumulators[(metric, key)] = RunningStatistics(self.relativeAccuracy)
+            accumulator.update(batch)
+
+    # Desc: Merges the partial results of another run or shard into this one
+    # Input: OnlineStatistics with the same bucket size
+    # Output: None
+    def merge(self, other):
+        if other.bucket != self.bucket:
+            raise ValueError("Can't merge online statistics with different bucket sizes")
+        for key, accumulator in other.accumulators.items():
+            if key in self.accumulators:
+                self.accumulators[key].merge(accumulator)
+            else:
+                self.accumulators[key] = accumulator
+
+    # Desc: Builds the aggregate table, same layout as StatisticalTest.aggregate()
+    # Input: Quantiles to estimate from the sketches
+    # Output: DataFrame with one row per (metric, bucket)
+    def to_frame(self, quantiles=(0.25, 0.5, 0.75)):
+        rows = []
+        for (metric, bucketStart), accumulator in sorted(self.accumulators.items()):
+            row = {
+                "type": metric,
+                "bucket": pd.Timestamp(bucketStart, unit="s"),
+                "count": accumulator.count,
+                "mean": accumulator.mean,
+                "SD": accumulator.sd,
+                "min": accumulator.min,
+                "max": accumulator.max,
+            }
+            for quantile in quantiles:
+                row[f"q{round(quantile * 100):g}"] = accumulator.sketch.quantile(quantile)
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    # Desc: Persists the accumulator state so partial results can be merged by a later run
+    def save(self, outputFile):
+        with open(outputFile, "w") as file:
+            json.dump({
+                "bucket": self.bucket,
+                "relativeAccuracy": self.relativeAccuracy,
+                "accumulators": [[metric, bucketStart, accumulator.to_dict()] for (metric, bucketStart), accumulator in self.accumulators.items()],
+            }, file)
+
+    @classmethod
+    def load(cls, inputFile):
+        with open(inputFile, "r") as file:
+            state = json.load(file)
+        statistics = cls(state["bucket"], state["relativeAccuracy"])
+        for metric, bucketStart, accumulator in state["accumulators"]:
+            statistics.accumulators[(metric, bucketStart)] = RunningStatistics.from_dict(accumulator)
+        return statistics
@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import pandas as pd
+from instrumentation import report
+
+# embedded query store, one row per observation of every extracted data type
+DATABASE_FILE = "../data/health.sqlite"
+
+# columns of the typed data type frames (see typed_frame() in columnar.py) that don't hold the measured value
+NON_VALUE_COLUMNS = ["date", "time", "startTime", "endTime", "totalTime", "utcOffset", "source", "device", "unit"]
+
+
+class QueryStore:
+    def __init__(self, databaseFile=DATABASE_FILE) -> None:
+        self.databaseFile = databaseFile
+        self.connection = sqlite3.connect(databaseFile)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS records (
+                type TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER,
+                utcOffset INTEGER,
+                value REAL,
+                source TEXT,
+                device TEXT,
+                unit TEXT
+            )"""
+        )
+        # every lookup is "type(s) between t0 and t1"
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_type_start ON records (type, start)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    # Desc: Loads the typed data of a single data type into the store, rows of that type within the same time range are replaced
+    # Input: dataTypeString (e.g. HKQuantityTypeIdentifierHeartRate), the typed DataFrame of that data type and optionally the unit of
+    #        the type (see data_types.py), used when the DataFrame has no unit column
+    # Output: Number of rows loaded
+    def load_data_type(self, dataTypeString, df, unit=None):
+        if df.empty:
+            return 0
+
+        # samples are stored at the time they were measured (startTime), the creation time is only used if there is no start time
+        startColumn = "startTime" if "startTime" in df.columns else "time"
+        valueColumn = [column for column in df.columns if column not in NON_VALUE_COLUMNS][0]
+        rows = pd.DataFrame({
+            "type": dataTypeString,
+            "start": epoch_seconds(df[startColumn]),
+            "end": epoch_seconds(df["endTime"]) if "endTime" in df.columns else None,
+            "utcOffset": df["utcOffset"],
+            "value": df[valueColumn],
+            "source": df["source"].astype("object") if "source" in df.columns else None,
+            "device": df["device"].astype("object") if "device" in df.columns else None,
+            "unit": df["unit"].astype("object") if "unit" in df.columns else unit,
+        })
+
+        sizeBefore = os.path.getsize(self.databaseFile)
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM records WHERE type = ? AND start BETWEEN ? AND ?",
+                (dataTypeString, int(rows["start"].min()), int(rows["start"].max())),
+            )
+            rows.to_sql("records", self.connection, if_exists="append", index=False)
+        # replaced rows free pages that are reused, so only the growth of the database file is counted
+        report.count(bytesWritten=max(0, os.path.getsize(self.databaseFile) - sizeBefore))
+        return len(rows)
+
+    # Desc: Looks up the observations of one or several data types within a time range
+    # Input: dataTypeString or list of dataTypeStrings, optionally the start (inclusive) and end (exclusive) of the range,
+    #        anything pandas can convert to a Timestamp, naive values are treated as UTC
+    # Output: DataFrame of type, start, end (UTC datetimes), utcOffset, value, source, device and unit ordered by type and start
+    def query(self, types, start=None, end=None):
+        if isinstance(types, str):
+            types = [types]
+        query = f"SELECT * FROM records WHERE type IN ({', '.join('?' * len(types))})"
+        params = list(types)
+        if start is not None:
+            query += " AND start >= ?"
+            params.append(to_epoch_seconds(start))
+        if end is not None:
+            query += " AND start < ?"
+            params.append(to_epoch_seconds(end))
+        query += " ORDER BY type, start"
+
+        df = pd.read_sql_query(query, self.connection, params=params)
+        df["start"] = pd.to_datetime(df["start"], unit="s", utc=True)
+        df["end"] = pd.to_datetime(df["end"], unit="s", utc=True)
+        return df
+
+
+# Desc: Converts a UTC datetime column to epoch seconds
+# Input: Series of timezone aware datetimes
+# Output: Series of int64 epoch seconds
+def epoch_seconds(column):
+    return (column - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+
+
+# Desc: Converts a single point in time to epoch seconds
+# Input: Anything pandas can convert to a Timestamp, naive values are treated as UTC
+# Output: Epoch seconds (int)
+def to_epoch_seconds(value):
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return int(timestamp.timestamp())
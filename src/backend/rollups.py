@@ -0,0 +1,222 @@
+import os
+import numpy as np
+import pandas as pd
+from instrumentation import report
+from online_statistics import BUCKET_SECONDS
+from storage import PARQUET_DIR
+
+# Desc: Multi resolution rollups of every quantity type and a downsampler that serves any time window with at most N points, so a
+#       multi-year history can be plotted without ever loading all of its samples: the window is read from the finest rollup that
+#       still holds a manageable number of points and reduced to N points with Largest-Triangle-Three-Buckets (LTTB)
+
+# root of the rollups, one file per data type and resolution: ../data/rollups/<outputFileName>/<resolution>.parquet
+ROLLUP_DIR = "../data/rollups"
+# resolutions from finest to coarsest, every resolution is computed from the previous one (buckets are in local time, weeks start on Monday)
+RESOLUTIONS = ["minute", "hour", "day", "week"]
+# rows per parquet row group, so a window read of a multi-year minute rollup only decodes the row groups it overlaps
+ROW_GROUP_SIZE = 65536
+# the downsampler reads a source holding up to this many times the requested number of points, LTTB then picks the points to keep
+OVERSAMPLING = 4
+# 1970-01-05 (the first Monday after the epoch) in seconds, weeks are aligned to it
+FIRST_MONDAY_SECONDS = 4 * 86400
+
+
+# Desc: Builds the path of the rollup file of a data type and resolution
+# Input: Output file name of the data type (see data_types.py) and resolution (see RESOLUTIONS)
+# Output: Path of the parquet file
+def rollup_path(outputFileName, resolution):
+    return os.path.join(ROLLUP_DIR, outputFileName, f"{resolution}.parquet")
+
+
+# Desc: Timestamp column of a data type, the measurement time of point samples and the start of interval samples
+# Input: Data type dictionary
+# Output: Column name
+def time_column(object):
+    return "startTime" if "startTime" in object["columns"] else "time"
+
+
+# Desc: Start of the bucket every local time falls into
+# Input: int64 array of local epoch seconds and resolution
+# Output: int64 array of local epoch seconds
+def bucket_seconds(localSeconds, resolution):
+    size = BUCKET_SECONDS[resolution]
+    if resolution == "week":
+        return (localSeconds - FIRST_MONDAY_SECONDS) // size * size + FIRST_MONDAY_SECONDS
+    return localSeconds // size * size
+
+
+# Desc: Rolls up the samples of a data type into its finest resolution
+# Input: DataFrame with the timestamp column, utcOffset and the value column of a data type (see typed_frame() in columnar.py)
+# Output: DataFrame with one row per non empty bucket (see combine())
+def minute_rollup(df, timeColumn, valueColumn):
+    df = df[df[valueColumn].notna()]
+    # local wall clock time in seconds, so minutes, hours and days follow the timezone the sample was recorded in
+    localSeconds = df[timeColumn].dt.tz_localize(None).to_numpy().astype("datetime64[s]").astype(np.int64) + df["utcOffset"].to_numpy().astype(np.int64) * 60
+    values = df[valueColumn].to_numpy(dtype=np.float64)
+    samples = pd.DataFrame({
+        "bucket": bucket_seconds(localSeconds, "minute"),
+        "count": np.ones(len(values), dtype=np.int64),
+        "sum": values,
+        "m2": np.zeros(len(values)),
+        "min": values,
+        "max": values,
+    })
+    return combine(samples, "minute")
+
+
+# Desc: Combines buckets into the buckets of a coarser resolution, the variance is merged with Chan's parallel formula so it stays
+#       accurate however many levels it is carried through
+# Input: DataFrame with bucket (int64 local epoch seconds), count, sum, m2 (sum of squared deviations from the mean), min and max,
+#        and the resolution to combine into
+# Output: DataFrame with bucket, count, sum, mean, m2, SD (sample standard deviation, nan for single samples), min and max
+def combine(rollup, resolution):
+    buckets = bucket_seconds(rollup["bucket"].to_numpy(), resolution)
+    grouped = rollup.groupby(buckets, sort=True)
+    combined = grouped.agg({"count": "sum", "sum": "sum", "min": "min", "max": "max"})
+    combined["mean"] = combined["sum"] / combined["count"]
+
+    # m2 = sum of the m2 of the parts + sum of count * (mean of the part - combined mean)^2
+    partMeans = rollup["sum"].to_numpy() / rollup["count"].to_numpy()
+    spread = rollup["count"].to_numpy() * (partMeans - combined["mean"].reindex(buckets).to_numpy()) ** 2
+    combined["m2"] = grouped["m2"].sum() + pd.Series(spread).groupby(buckets, sort=True).sum().to_numpy()
+    combined["SD"] = np.sqrt(combined["m2"] / (combined["count"] - 1)).where(combined["count"] > 1)
+
+    combined = combined.rename_axis("bucket").reset_index()
+    return combined[["bucket", "count", "sum", "mean", "m2", "SD", "min", "max"]]
+
+
+# Desc: Writes the rollups of a data type at every resolution, from all its extracted years
+# Input: Data type dictionary (see data_types.py)
+# Output: List of the rollup files that were written
+def build_rollups(object):
+    dataTypeDir = os.path.join(PARQUET_DIR, object["outputFileName"])
+    timeColumn = time_column(object)
+    df = pd.read_parquet(dataTypeDir, columns=[timeColumn, "utcOffset", object["valueColumn"]])
+
+    outputFiles = []
+    rollup = None
+    for resolution in RESOLUTIONS:
+        if rollup is None:
+            rollup = minute_rollup(df, timeColumn, object["valueColumn"])
+        else:
+            rollup = combine(rollup, resolution)
+        outputFile = rollup_path(object["outputFileName"], resolution)
+        os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+        # buckets are stored as naive local datetimes, the same as StatisticalTest.aggregate()
+        rollup.assign(bucket=pd.to_datetime(rollup["bucket"], unit="s")).to_parquet(outputFile, index=False, row_group_size=ROW_GROUP_SIZE)
+        report.count(bytesWritten=os.path.getsize(outputFile))
+        outputFiles.append(outputFile)
+    return outputFiles
+
+
+# Desc: Reads the buckets of a rollup within a time window
+# Input: Output file name of the data type, resolution, start and end of the window (naive local datetimes, None for unbounded) and
+#        optionally the list of columns to load
+# Output: DataFrame sorted by bucket
+def read_rollup(outputFileName, resolution, start=None, end=None, columns=None):
+    filters = []
+    if start is not None:
+        filters.append(("bucket", ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append(("bucket", "<", pd.Timestamp(end)))
+    return pd.read_parquet(rollup_path(outputFileName, resolution), columns=columns, filters=filters or None)
+
+
+# Desc: Reads the samples of a data type within a time window
+# Input: Data type dictionary, start and end of the window (naive local datetimes, None for unbounded)
+# Output: DataFrame with the naive local time and the value of every sample, sorted by time
+def read_samples(object, start=None, end=None):
+    timeColumn = time_column(object)
+    valueColumn = object["valueColumn"]
+    # the stored timestamps are UTC, so the partitions are filtered with a margin of the largest timezone offsets first
+    filters = []
+    if start is not None:
+        filters.append((timeColumn, ">=", pd.Timestamp(start).tz_localize("UTC") - pd.Timedelta(hours=14)))
+    if end is not None:
+        filters.append((timeColumn, "<", pd.Timestamp(end).tz_localize("UTC") + pd.Timedelta(hours=14)))
+    df = pd.read_parquet(os.path.join(PARQUET_DIR, object["outputFileName"]), columns=[timeColumn, "utcOffset", valueColumn], filters=filters or None)
+
+    samples = pd.DataFrame({
+        "time": df[timeColumn].dt.tz_localize(None) + pd.to_timedelta(df["utcOffset"], unit="min"),
+        "value": df[valueColumn].to_numpy(dtype=np.float64),
+    })
+    selected = samples["value"].notna()
+    if start is not None:
+        selected &= samples["time"] >= pd.Timestamp(start)
+    if end is not None:
+        selected &= samples["time"] < pd.Timestamp(end)
+    return samples[selected].sort_values("time", kind="stable", ignore_index=True)
+
+
+# Desc: Largest-Triangle-Three-Buckets downsampling: the points are split into threshold - 2 buckets between the first and the last
+#       point, and from every bucket the point forming the largest triangle with the point kept from the previous bucket and the
+#       average of the next bucket is kept, which preserves the peaks and the shape of the series
+# Input: numpy arrays of x (increasing) and y values and the number of points to keep
+# Output: int64 array of the indices of the points to keep (all points if there are no more than threshold)
+def lttb(x, y, threshold):
+    length = len(x)
+    if threshold >= length:
+        return np.arange(length)
+    if threshold < 3:
+        raise ValueError("LTTB always keeps the first and the last point, threshold must be at least 3")
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # bucket boundaries of the points between the first and the last one
+    edges = (np.arange(threshold - 1) * (length - 2) / (threshold - 2)).astype(np.int64) + 1
+    edges[-1] = length - 1
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = length - 1
+    previous = 0
+    for index in range(threshold - 2):
+        start, end = edges[index], edges[index + 1]
+        # average of the next bucket (the last point for the last bucket)
+        nextStart, nextEnd = end, (edges[index + 2] if index + 2 < len(edges) else length)
+        averageX = x[nextStart:nextEnd].mean()
+        averageY = y[nextStart:nextEnd].mean()
+        # twice the triangle areas, the constant factor doesn't change which point is the largest
+        areas = np.abs((x[previous] - averageX) * (y[start:end] - y[previous]) - (x[previous] - x[start:end]) * (averageY - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[index + 1] = previous
+    return selected
+
+
+# Desc: Serves a time window of a data type with at most maxPoints points, read from the finest source (the samples themselves or a
+#       rollup) that holds no more than OVERSAMPLING * maxPoints points within the window, then reduced with LTTB
+# Input: Data type dictionary (see data_types.py), start and end of the window (naive local datetimes, None for the whole history),
+#        the maximum number of points and the statistic of the rollup buckets to plot ("mean", "sum", "min" or "max")
+# Output: Tuple of (DataFrame with time and value, plus count, min and max when read from a rollup, and the source: "sample" or a resolution)
+def downsample(object, start=None, end=None, maxPoints=1000, statistic="mean"):
+    outputFileName = object["outputFileName"]
+    # the day rollup is small and gives the exact number of samples and the extent of the data within the window
+    dayStart = pd.Timestamp(start).floor("D") if start is not None else None
+    days = read_rollup(outputFileName, "day", dayStart, end, columns=["bucket", "count"])
+    if days.empty:
+        return pd.DataFrame({"time": pd.Series(dtype="datetime64[ns]"), "value": pd.Series(dtype=np.float64)}), "sample"
+    windowStart = pd.Timestamp(start) if start is not None else days["bucket"].iloc[0]
+    windowEnd = pd.Timestamp(end) if end is not None else days["bucket"].iloc[-1] + pd.Timedelta(days=1)
+    windowSeconds = (windowEnd - windowStart).total_seconds()
+    samples = int(days["count"].sum())
+
+    limit = OVERSAMPLING * maxPoints
+    source = RESOLUTIONS[-1]
+    if samples <= limit:
+        source = "sample"
+    else:
+        for resolution in RESOLUTIONS:
+            # a resolution has at most one point per bucket of the window (and of the days holding data) and never more points than samples
+            bucketsPerDay = max(86400 / BUCKET_SECONDS[resolution], 1)
+            if min(windowSeconds / BUCKET_SECONDS[resolution] + 1, len(days) * bucketsPerDay, samples) <= limit:
+                source = resolution
+                break
+
+    if source == "sample":
+        points = read_samples(object, start, end)
+    else:
+        rollup = read_rollup(outputFileName, source, start, end, columns=["bucket", "count", statistic, "min", "max"])
+        points = rollup.rename(columns={"bucket": "time", statistic: "value"})[["time", "value", "count", "min", "max"]]
+
+    keep = lttb(points["time"].to_numpy().astype("datetime64[s]").astype(np.float64), points["value"].to_numpy(), maxPoints)
+    return points.iloc[keep].reset_index(drop=True), source
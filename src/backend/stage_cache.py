@@ -0,0 +1,231 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import uuid
+from instrumentation import report
+
+# content addressed cache of the pipeline stages, every entry is a directory named after its key: ../data/cache/<key>/
+CACHE_DIR = "../data/cache"
+# the least recently used entries are evicted once the cache grows past this size
+DEFAULT_MAX_BYTES = 2 * 2**30
+# bump when the format of the cached outputs changes, so entries written by an older version are never reused
+CACHE_VERSION = 1
+# directory of the backend modules, the code fingerprint of a stage follows the functions it calls within these modules
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# name of the file describing an entry (the names of its output files), its mtime marks the last use of the entry
+ENTRY_FILE = "entry.json"
+
+
+class StageCache:
+    # Desc: Caches the output files of a stage under a key built from the hashes of its input files and its configuration
+    def __init__(self, cacheDir=CACHE_DIR, maxBytes=DEFAULT_MAX_BYTES, enabled=True) -> None:
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.enabled = enabled
+        # absolute path -> [size, mtime_ns, digest], so unchanged input files (e.g. a multi GB export.xml) are only hashed once
+        self.digestFile = os.path.join(cacheDir, "digests.json")
+        self.digests = None
+
+    # Desc: sha256 of a file's content, remembered by size and modification time
+    # Input: File path
+    # Output: Hex digest
+    def file_digest(self, path):
+        if self.digests is None:
+            self.digests = {}
+            if os.path.exists(self.digestFile):
+                with open(self.digestFile, "r") as file:
+                    self.digests = json.load(file)
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.digests.get(path)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            while chunk := file.read(2**20):
+                digest.update(chunk)
+        self.digests[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        os.makedirs(self.cacheDir, exist_ok=True)
+        with open(self.digestFile, "w") as file:
+            json.dump(self.digests, file)
+        return digest.hexdigest()
+
+    # Desc: Builds the key of a stage
+    # Input: Stage name, list of input file paths and the stage configuration (anything json serializable)
+    # Output: Hex digest
+    def key(self, stage, inputFiles, config):
+        description = {
+            "version": CACHE_VERSION,
+            "stage": stage,
+            "inputs": [self.file_digest(inputFile) for inputFile in inputFiles],
+            "config": config,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    # Desc: Copies the output files of a cached stage to their destination
+    # Input: Key and the paths the output files are restored to (same order as when they were stored)
+    # Output: True on a cache hit
+    def restore(self, key, outputFiles):
+        entryDir = os.path.join(self.cacheDir, key)
+        entryFile = os.path.join(entryDir, ENTRY_FILE)
+        if not self.enabled or not os.path.exists(entryFile):
+            return False
+        with open(entryFile, "r") as file:
+            entry = json.load(file)
+        if len(entry["outputs"]) != len(outputFiles):
+            return False
+
+        for index, outputFile in enumerate(outputFiles):
+            os.makedirs(os.path.dirname(outputFile) or ".", exist_ok=True)
+            shutil.copyfile(os.path.join(entryDir, str(index)), outputFile)
+        # mark the entry as recently used
+        os.utime(entryFile)
+        report.count(cacheHits=1)
+        return True
+
+    # Desc: Stores the output files of a stage, then evicts the least recently used entries if the cache is too large
+    # Input: Key and the paths of the output files
+    # Output: None
+    def store(self, key, outputFiles):
+        if not self.enabled:
+            return
+        # the entry is written to a temporary directory first, so an interrupted run never leaves a partial entry behind
+        entryDir = os.path.join(self.cacheDir, key)
+        temporaryDir = os.path.join(self.cacheDir, f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(temporaryDir)
+        for index, outputFile in enumerate(outputFiles):
+            shutil.copyfile(outputFile, os.path.join(temporaryDir, str(index)))
+        with open(os.path.join(temporaryDir, ENTRY_FILE), "w") as file:
+            json.dump({"outputs": [os.path.basename(outputFile) for outputFile in outputFiles]}, file)
+
+        shutil.rmtree(entryDir, ignore_errors=True)
+        os.rename(temporaryDir, entryDir)
+        self.evict()
+
+    # Desc: Runs a stage unless its output files are cached, the outputs of a stage that ran are added to the cache
+    # Input: Stage name, input file paths, stage configuration, output file paths and the function that runs the stage
+    # Output: True if the outputs were restored from the cache
+    def run(self, stage, inputFiles, config, outputFiles, function):
+        if not self.enabled:
+            function()
+            return False
+        key = self.key(stage, inputFiles, config)
+        if self.restore(key, outputFiles):
+            return True
+        function()
+        self.store(key, outputFiles)
+        return False
+
+    # Desc: Removes the least recently used entries until the cache fits in maxBytes
+    # Input: None
+    # Output: Number of entries removed
+    def evict(self):
+        entries = []
+        totalBytes = 0
+        for name in os.listdir(self.cacheDir):
+            entryDir = os.path.join(self.cacheDir, name)
+            entryFile = os.path.join(entryDir, ENTRY_FILE)
+            if not os.path.exists(entryFile):
+                continue
+            size = sum(os.path.getsize(os.path.join(entryDir, file)) for file in os.listdir(entryDir))
+            entries.append((os.path.getmtime(entryFile), size, entryDir))
+            totalBytes += size
+
+        removed = 0
+        for lastUsed, size, entryDir in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalBytes -= size
+            removed += 1
+        return removed
+
+    # Desc: Removes every entry
+    def clear(self):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+        self.digests = None
+
+
+# Desc: Fingerprint of the code of functions (or of every method of a class), part of the stage configuration so editing a stage
+#       invalidates its cache entries, the bytecode doesn't change with comments or formatting. The functions, classes and constants
+#       of the backend that the code refers to (e.g. a helper called by the stage, or a registry it reads) are followed recursively,
+#       so they don't have to be listed
+# Input: Functions and/or classes
+# Output: Hex digest
+def code_fingerprint(*functions):
+    digest = hashlib.sha256()
+    seen = set()
+
+    def add_code(code, namespace):
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for constant in code.co_consts:
+            # nested functions (e.g. lambdas, comprehensions) are code objects whose repr contains their memory address
+            if hasattr(constant, "co_code"):
+                add_code(constant, namespace)
+            else:
+                digest.update(repr(constant).encode())
+        for name in code.co_names:
+            if name in namespace:
+                add_value(namespace[name])
+
+    def add_value(value):
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+        if isinstance(value, type) or callable(value):
+            # only the code of the backend, the libraries are part of the environment
+            if not is_backend(value):
+                return
+            if isinstance(value, type):
+                for name, method in sorted(vars(value).items()):
+                    if hasattr(method, "__code__"):
+                        add_value(method)
+                return
+            # decorated functions (e.g. lru_cache) keep the function they wrap in __wrapped__
+            function = inspect.unwrap(value)
+            if hasattr(function, "__code__"):
+                digest.update(stable_repr(function.__defaults__).encode())
+                add_code(function.__code__, function.__globals__)
+        elif isinstance(value, (str, int, float, bool)):
+            digest.update(repr(value).encode())
+        elif isinstance(value, (tuple, list, dict, set, frozenset)):
+            digest.update(stable_repr(value).encode())
+            # tables of functions (e.g. the worker of every kind of attachment)
+            for item in (value.values() if isinstance(value, dict) else value):
+                if isinstance(item, (tuple, list, dict)) or callable(item):
+                    add_value(item)
+
+    for function in functions:
+        add_value(function)
+    return digest.hexdigest()
+
+
+# Desc: Whether a function or class is defined in one of the backend modules (the directory of this file)
+# Input: Function or class
+# Output: True for backend code
+def is_backend(value):
+    module = sys.modules.get(getattr(value, "__module__", None) or "")
+    moduleFile = getattr(module, "__file__", None)
+    return moduleFile is not None and os.path.dirname(os.path.abspath(moduleFile)) == BACKEND_DIR
+
+
+# Desc: repr that doesn't depend on the process, sets (whose order changes with the hash seed) are sorted
+# Input: Value
+# Output: String
+def stable_repr(value):
+    if isinstance(value, (set, frozenset)):
+        return "{" + ", ".join(sorted(stable_repr(item) for item in value)) + "}"
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__ + "(" + ", ".join(stable_repr(item) for item in value) + ")"
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{stable_repr(key)}: {stable_repr(item)}" for key, item in value.items()) + "}"
+    if value is None or isinstance(value, (str, bytes, int, float, bool)):
+        return repr(value)
+    # other objects (e.g. functions) are represented by their type, their repr can hold a memory address
+    return type(value).__name__
@@ -1,6 +1,26 @@
 import pandas as pd
-from scipy.stats import spearmanr, pearsonr
+import numpy as np
+from scipy.stats import spearmanr, pearsonr, rankdata, t
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
 import os
+from storage import local_time, write_csv
+
+# bucket sizes supported by StatisticalTest.aggregate(), weeks are built from days
+BUCKETS = {
+    'minute': pd.Timedelta(minutes=1),
+    'hour': pd.Timedelta(hours=1),
+    'day': pd.Timedelta(days=1),
+    'week': pd.Timedelta(weeks=1),
+}
+
+# output files of StatisticalTest.descriptive_statistics()
+DESCRIPTIVE_STATISTICS_FILES = {
+    'heartRate': "../data/descriptive_statistics/mean_heart_rate_three_days.csv",
+    'steps': "../data/descriptive_statistics/mean_steps_three_days.csv",
+    'gaitLength': "../data/descriptive_statistics/mean_gait_length_three_days.csv",
+    'spo2': "../data/descriptive_statistics/mean_spo2_three_days.csv",
+}
 
 class StatisticalTest:
     def __init__(self,heartRateFile=None, restingHeartRate=None, stepsFile=None, gaitFile=None, spo2File=None) -> None:
@@ -13,43 +33,70 @@ class StatisticalTest:
             os.makedirs("../data/descriptive_statistics")
 
 
-    def mean_heart_rate_three_days(self, df):
-        dfCopy = df.copy()
-        dfCopy['hour'] = pd.to_datetime(dfCopy['time'], format='%H:%M:%S').dt.hour
-
-        # Calculate mean heart rate per hour in the copy
-        mean_heart_rate = dfCopy.groupby(['date', 'hour'])['heartRate'].mean().reset_index()
-        mean_heart_rate.columns = ['date', 'hour', 'meanHeartRate']
+    # Desc: Adds the mean of a value column per (date, local hour) to every observation
+    # Input: Typed DataFrame of a data type, the timestamp column that defines the hour, the value column and the name of the mean column
+    # Output: DataFrame with the added hour and mean columns
+    def mean_per_hour(self, df, timeColumn, valueColumn, meanColumn):
+        # local hour of each measurement, converted once and used for both the groupby and the merge
+        df = df.assign(hour=local_time(df, timeColumn).dt.hour)
+        means = df.groupby(['date', 'hour'])[valueColumn].mean().reset_index()
+        means.columns = ['date', 'hour', meanColumn]
+        return pd.merge(df, means, how='left', on=['date', 'hour'])
 
-        # Merge mean_heart_rate with the original df
-        df = pd.merge(df, mean_heart_rate, how='left', left_on=['date', pd.to_datetime(df['time'], format='%H:%M:%S').dt.hour], right_on=['date', 'hour'])
-        
-        return df
+    def mean_heart_rate_three_days(self, df):
+        return self.mean_per_hour(df, 'time', 'heartRate', 'meanHeartRate')
 
     def mean_steps_three_days(self, df):
-        dfCopy = df.copy()
-        dfCopy['hour'] = pd.to_datetime(dfCopy['startTime'], format='%H:%M:%S').dt.hour
-        meanSteps = dfCopy.groupby(['date', 'hour'])['steps'].mean().reset_index()
-        meanSteps.columns = ['date', 'hour', 'meanSteps']
-        df = pd.merge(df, meanSteps, how='left', left_on=['date', pd.to_datetime(df['startTime'], format='%H:%M:%S').dt.hour], right_on=['date', 'hour'])
-
-        return df
+        return self.mean_per_hour(df, 'startTime', 'steps', 'meanSteps')
 
     def mean_gait_three_days(self, df):
-        dfCopy = df.copy()
-        dfCopy['hour'] = pd.to_datetime(dfCopy['startTime'], format="%H:%M:%S").dt.hour
-        meanGaitLength = dfCopy.groupby(['date', 'hour'])['gaitLength'].mean().reset_index()
-        meanGaitLength.columns = ['date', 'hour', 'meanGaitLength']
-        df = pd.merge(df, meanGaitLength, how='left', left_on=['date', pd.to_datetime(df['startTime'], format='%H:%M:%S').dt.hour], right_on=['date', 'hour'])
-        return df
+        return self.mean_per_hour(df, 'startTime', 'gaitLength', 'meanGaitLength')
 
     def mean_spo2_three_days(self, df):
-        dfCopy = df.copy()
-        dfCopy['hour'] = pd.to_datetime(dfCopy['startTime'], format='%H:%M:%S').dt.hour
-        meanSpo2 = dfCopy.groupby(['date', 'hour'])['SpO2'].mean().reset_index()
-        meanSpo2.columns = ['date','hour','meanSpo2']
-        df = pd.merge(df, meanSpo2, how='left', left_on=['date', pd.to_datetime(df['startTime'], format='%H:%M:%S').dt.hour], right_on=['date', 'hour'])
-        return df
+        return self.mean_per_hour(df, 'startTime', 'SpO2', 'meanSpo2')
+
+    # Desc: Aggregates any number of metrics into time buckets in a single grouped pass
+    # Input: Long format DataFrame with one row per observation (e.g. the output of QueryStore.query()), the bucket size
+    #        (minute, hour, day or week, in the local time of the measurement), the quantiles to compute, optionally the metrics
+    #        to keep and the names of the metric, timestamp (UTC) and value columns
+    # Output: Compact DataFrame with one row per (metric, bucket): count, mean, SD, min, max and one column per quantile (e.g. q50)
+    def aggregate(self, df, bucket='hour', quantiles=(0.25, 0.5, 0.75), metrics=None, metricColumn='type', timeColumn='start', valueColumn='value'):
+        if bucket not in BUCKETS:
+            raise ValueError(f"Unknown bucket '{bucket}', expected one of {list(BUCKETS)}")
+        if metrics is not None:
+            df = df[df[metricColumn].isin(metrics)]
+        # a query without any row (e.g. an export without data in the requested year) returns object columns (see _group_statistics())
+        df = df.assign(utcOffset=df['utcOffset'].astype(np.int64))
+
+        localTime = local_time(df, timeColumn)
+        if bucket == 'week':
+            # weeks start on Monday
+            day = localTime.dt.floor(BUCKETS['day'])
+            buckets = day - pd.to_timedelta(day.dt.weekday, unit='D')
+        else:
+            buckets = localTime.dt.floor(BUCKETS[bucket])
+
+        return self._group_statistics(df[valueColumn], [df[metricColumn], buckets.rename('bucket')], quantiles)
+
+    # Desc: Statistics of any number of metrics per context (e.g. heart rate during sleep, workouts or rest, see contexts.py)
+    # Input: Long format DataFrame with one row per observation and its context columns (see join_contexts()), the quantiles to compute
+    #        and the names of the metric, context and value columns
+    # Output: DataFrame with one row per (metric, context, detail): count, mean, SD, min, max and one column per quantile (e.g. q50)
+    def context_statistics(self, df, quantiles=(0.25, 0.5, 0.75), metricColumn='type', contextColumns=('context', 'detail'), valueColumn='value'):
+        return self._group_statistics(df[valueColumn], [df[metricColumn]] + [df[column] for column in contextColumns], quantiles)
+
+    # Desc: Statistics of the values of every group, shared by aggregate() and context_statistics()
+    # Input: Series of values, the list of key Series to group by and the quantiles to compute
+    # Output: DataFrame with one row per group: the keys, count, mean, SD, min, max and one column per quantile (e.g. q50)
+    def _group_statistics(self, values, keys, quantiles):
+        # a query without any row (e.g. an export without Watch data) returns object columns, which can't be aggregated
+        grouped = values.astype(np.float64).groupby(keys, observed=True, sort=True)
+        statistics = grouped.agg(['count', 'mean', 'std', 'min', 'max']).rename(columns={'std': 'SD'})
+        if quantiles:
+            quantileValues = grouped.quantile(list(quantiles)).unstack().reindex(columns=list(quantiles))
+            quantileValues.columns = [f"q{round(quantile * 100):g}" for quantile in quantileValues.columns]
+            statistics = statistics.join(quantileValues)
+        return statistics.reset_index()
 
     def standard_deviation(self, df, columnName):
         return df[columnName].std()
@@ -78,32 +125,119 @@ class StatisticalTest:
             print(f"There is a positive correlation between the two variables @: {rho}")
         
         if p < 0.05:
+            print(f"The correlation is statistically significant. p-val = {p}")
+        else:
             print(f"The correlation is not statistically significant. p-val = {p}")
+
+        return rho, p
+
+    # Desc: Pearson and Spearman correlations between every pair of metrics, over a range of time lags, on aligned bucket arrays
+    # Input: Aggregate table (see aggregate()), the lags to scan (in buckets, a positive lag pairs metric1 with metric2 that many buckets later),
+    #        the number of permutations (permutation p-value) and bootstrap resamples (95% confidence interval) per pair, the number of
+    #        worker processes used for the resampling, the bucket size of the table, the statistic to correlate and the random seed
+    # Output: DataFrame with one row per (metric1, metric2, lag, method): n, r, p and, if requested, pPermutation, ciLow and ciHigh
+    def correlations(self, aggregates, lags=(0,), permutations=0, bootstraps=0, workers=1, bucket='hour', statistic='mean', seed=0, metricColumn='type'):
+        columns = ['metric1', 'metric2', 'lag', 'method', 'n', 'r', 'p'] + (['pPermutation'] if permutations else []) + (['ciLow', 'ciHigh'] if bootstraps else [])
+        wide = aggregates.pivot_table(index='bucket', columns=metricColumn, values=statistic)
+        # without at least two metrics (e.g. no data in the requested year) there is no pair to correlate
+        if wide.shape[1] < 2:
+            return pd.DataFrame(columns=columns)
+        # align every metric on the same complete bucket index so a lag of k buckets is always k buckets of time
+        wide = wide.reindex(pd.date_range(wide.index.min(), wide.index.max(), freq=BUCKETS[bucket]))
+        values = wide.to_numpy(dtype=np.float64)
+
+        tasks = [
+            (metric1, metric2, lag, values[:, i], values[:, j], permutations, bootstraps, seed)
+            for (i, metric1), (j, metric2) in combinations(enumerate(wide.columns), 2)
+            for lag in lags
+        ]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(correlation_task, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
         else:
-            print(f"The correlation is statistically significant. p-val = {p}")
+            results = [correlation_task(task) for task in tasks]
+        return pd.DataFrame([row for rows in results for row in rows], columns=columns)
 
 
     def descriptive_statistics(self):
         
-        heartRateDF = pd.read_csv(self.heartRateFile, index_col=0)
+        heartRateDF = pd.read_parquet(self.heartRateFile)
         meanHeartRate = self.mean_heart_rate_three_days(heartRateDF)
         sd = self.standard_deviation(heartRateDF,'heartRate')
         meanHeartRate['SD'] = sd
-        meanHeartRate.to_csv("../data/descriptive_statistics/mean_heart_rate_three_days.csv", index=False)
+        write_csv(meanHeartRate, DESCRIPTIVE_STATISTICS_FILES['heartRate'])
 
-        stepsDF = pd.read_csv(self.stepsFile, index_col=0)
+        stepsDF = pd.read_parquet(self.stepsFile)
         meanSteps = self.mean_steps_three_days(stepsDF)
-        meanSteps.to_csv("../data/descriptive_statistics/mean_steps_three_days.csv", index=False)
+        write_csv(meanSteps, DESCRIPTIVE_STATISTICS_FILES['steps'])
 
-        gaitDF = pd.read_csv(self.gaitFile,index_col=0)
+        gaitDF = pd.read_parquet(self.gaitFile)
         meanGaitLength = self.mean_gait_three_days(gaitDF)
-        meanGaitLength.to_csv('../data/descriptive_statistics/mean_gait_length_three_days.csv', index=False)
+        write_csv(meanGaitLength, DESCRIPTIVE_STATISTICS_FILES['gaitLength'])
 
-        spo2DF = pd.read_csv(self.spo2File, index_col=0)
+        spo2DF = pd.read_parquet(self.spo2File)
         meanSpo2 = self.mean_spo2_three_days(spo2DF)
-        meanSpo2.to_csv("../data/descriptive_statistics/mean_spo2_three_days.csv", index=False)
+        write_csv(meanSpo2, DESCRIPTIVE_STATISTICS_FILES['spo2'])
 
         # uncomment to run spearmans on mean heart rate and mean steps
         #self.spearman(meanSteps, meanHeartRate)
 
-        return heartRateDF, stepsDF, meanGaitLength
\ No newline at end of file
+        return heartRateDF, stepsDF, meanGaitLength
+
+
+# Desc: Row wise Pearson correlation, either argument can be a single array or a 2D array of arrays (one per row)
+# Input: Arrays with the observations on the last axis
+# Output: Correlation coefficient(s)
+def row_correlation(a, b):
+    a = a - a.mean(axis=-1, keepdims=True)
+    b = b - b.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (a * b).sum(axis=-1) / np.sqrt((a * a).sum(axis=-1) * (b * b).sum(axis=-1))
+
+
+# Desc: Computes the Pearson and Spearman correlation of a single metric pair at a single lag (run by StatisticalTest.correlations())
+# Input: Tuple of (metric1, metric2, lag, values1, values2, permutations, bootstraps, seed), values are aligned bucket arrays with NaN gaps
+# Output: List of two result rows (pearson, spearman)
+def correlation_task(task):
+    metric1, metric2, lag, x, y, permutations, bootstraps, seed = task
+    if lag > 0:
+        x, y = x[:-lag], y[lag:]
+    elif lag < 0:
+        x, y = x[-lag:], y[:lag]
+    # only the buckets where both metrics have a value
+    complete = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[complete], y[complete]
+    n = len(x)
+
+    rng = np.random.default_rng(seed)
+    if permutations and n > 2:
+        permutationIndex = rng.permuted(np.tile(np.arange(n), (permutations, 1)), axis=1)
+    if bootstraps and n > 2:
+        bootstrapIndex = rng.integers(0, n, (bootstraps, n))
+
+    rows = []
+    for method in ('pearson', 'spearman'):
+        a, b = (x, y) if method == 'pearson' else (rankdata(x), rankdata(y))
+        r = float(row_correlation(a, b)) if n > 2 else np.nan
+        row = {'metric1': metric1, 'metric2': metric2, 'lag': lag, 'method': method, 'n': n, 'r': r, 'p': np.nan}
+        if permutations:
+            row['pPermutation'] = np.nan
+        if bootstraps:
+            row['ciLow'], row['ciHigh'] = np.nan, np.nan
+        # a constant metric has no correlation (r is nan), so it has no p-value or confidence interval either
+        if np.isfinite(r):
+            # two sided p-value of the t statistic with n - 2 degrees of freedom (same as scipy's pearsonr/spearmanr)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                row['p'] = float(2 * t.sf(abs(r) * np.sqrt((n - 2) / (1 - r * r)), n - 2)) if abs(r) < 1 else 0.0
+            if permutations:
+                # permuting the ranks is the same as ranking the permuted values
+                permuted = row_correlation(a, b[permutationIndex])
+                row['pPermutation'] = float(((np.abs(permuted) >= abs(r)).sum() + 1) / (permutations + 1))
+            if bootstraps:
+                if method == 'pearson':
+                    resampled = row_correlation(x[bootstrapIndex], y[bootstrapIndex])
+                else:
+                    resampled = row_correlation(rankdata(x[bootstrapIndex], axis=1), rankdata(y[bootstrapIndex], axis=1))
+                row['ciLow'], row['ciHigh'] = np.nanpercentile(resampled, [2.5, 97.5])
+        rows.append(row)
+    return rows
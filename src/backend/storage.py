@@ -0,0 +1,179 @@
+import os
+import json
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from instrumentation import report
+
+# root of the typed columnar output, each data type is partitioned by year: ../data/parquet/<outputFileName>/year=<YYYY>/data.parquet
+PARQUET_DIR = "../data/parquet"
+
+# columns that hold a small set of repeated strings and are stored as categoricals
+CATEGORY_COLUMNS = ["source", "device", "unit"]
+# timestamp columns (raw export.xml strings), stored as timezone aware (UTC) datetimes, the local offset is kept in utcOffset
+TIME_COLUMNS = ["time", "startTime", "endTime"]
+# per type and year watermarks of the incremental ingestion (year -> dataTypeString -> latest creationDate ingested), every year is
+# extracted to its own partition and has its own watermark
+WATERMARK_FILE = os.path.join(PARQUET_DIR, "watermarks.json")
+# date format used by export.xml, e.g. "2023-01-01 10:00:00 -0500"
+WATERMARK_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+
+# Desc: Builds the path of the parquet file for a data type and year
+# Input: Output file name of the data type (see static_data() in main.py) and year (YYYY)
+# Output: Path of the parquet file
+def parquet_path(outputFileName, year):
+    return os.path.join(PARQUET_DIR, outputFileName, f"year={year}", "data.parquet")
+
+
+# Desc: Converts export.xml timestamps ("YYYY-MM-DD HH:MM:SS +HHMM") to epoch seconds in one vectorized pass over their bytes
+# Input: Sequence of timestamp strings
+# Output: Tuple of (int64 array of epoch seconds (UTC), int16 array of the timezone offsets in minutes)
+def parse_timestamps(values):
+    raw = np.asarray(values, dtype="S26")
+    if raw.size and (np.char.str_len(raw) != 25).any():
+        raise ValueError("Unexpected timestamp format, expected 'YYYY-MM-DD HH:MM:SS +HHMM'")
+    return parse_timestamp_bytes(raw.view(np.uint8).reshape(-1, 26)[:, :25])
+
+
+# Desc: Same as parse_timestamps(), for timestamps that are already laid out as fixed width bytes (see columnar.py)
+# Input: uint8 array with one row of 25 bytes per timestamp
+# Output: Tuple of (int64 array of epoch seconds (UTC), int16 array of the timezone offsets in minutes)
+def parse_timestamp_bytes(raw):
+    # the digits are converted one byte column at a time, so no int64 copy of the whole matrix is made
+    def number(first, last):
+        value = np.zeros(len(raw), dtype=np.int64)
+        for index in range(first, last):
+            value = value * 10 + (raw[:, index].astype(np.int64) - ord("0"))
+        return value
+
+    # days since the epoch of the local date, built through numpy's calendar arithmetic
+    months = (number(0, 4) - 1970) * 12 + number(5, 7) - 1
+    days = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + number(8, 10) - 1
+    localSeconds = days * 86400 + number(11, 13) * 3600 + number(14, 16) * 60 + number(17, 19)
+
+    sign = np.where(raw[:, 20] == ord("-"), -1, 1)
+    utcOffsets = sign * (number(21, 23) * 60 + number(23, 25))
+    return localSeconds - utcOffsets * 60, utcOffsets.astype(np.int16)
+
+
+# Desc: Converts a timezone aware timestamp column back to the local wall clock time it was recorded in
+# Input: Typed DataFrame (see typed_frame() in columnar.py) and the name of a timestamp column
+# Output: Series of naive local datetimes
+def local_time(df, column):
+    return df[column].dt.tz_localize(None) + pd.to_timedelta(df["utcOffset"], unit="min")
+
+
+# Desc: Writes a typed DataFrame for a data type and year
+# Input: DataFrame, output file name of the data type and year (YYYY)
+# Output: Path of the parquet file that was written
+def write_data_frame(df, outputFileName, year):
+    outputFile = parquet_path(outputFileName, year)
+    os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+    df.to_parquet(outputFile, index=False)
+    report.count(bytesWritten=os.path.getsize(outputFile))
+    return outputFile
+
+
+# Desc: Writes a DataFrame as a CSV file (e.g. the descriptive statistics)
+# Input: DataFrame and path of the CSV file
+# Output: Path of the CSV file that was written
+def write_csv(df, outputFile):
+    df.to_csv(outputFile, index=False)
+    report.count(bytesWritten=os.path.getsize(outputFile))
+    return outputFile
+
+
+# Desc: Key of every sample of a typed DataFrame, a hash of all of its columns (including the start time), values are rounded as
+#       the pieces of a prorated sample (see deduplication.py) cut twice can differ in the last bits
+# Input: Typed DataFrame
+# Output: uint64 array, one key per row
+def sample_keys(df):
+    # only the float columns, rounding a frame with datetime columns warns
+    return pd.util.hash_pandas_object(df.round({column: 9 for column in df.select_dtypes("float").columns}), index=False).to_numpy()
+
+
+# Desc: Appends a typed DataFrame to the existing data of a data type and year, new samples that are already stored are dropped
+# Input: DataFrame, output file name of the data type and year (YYYY), optionally a function applied to the combined DataFrame
+#        before it is written (e.g. deduplicate_sources() in deduplication.py) and the first creation date (see the date column) of the
+#        stored samples the new ones are compared to (all stored samples if None)
+# Output: Path of the parquet file that was written
+def append_data_frame(df, outputFileName, year, merge=None, since=None):
+    outputFile = parquet_path(outputFileName, year)
+    if not os.path.exists(outputFile):
+        return write_data_frame(df if merge is None else merge(df), outputFileName, year)
+    if df.empty:
+        return outputFile
+
+    stored = pd.read_parquet(outputFile)
+    # timestamps read back from parquet have another timezone object (and unit), concat would turn the two into object columns
+    for column in TIME_COLUMNS:
+        if column in df.columns and column in stored.columns:
+            df[column] = df[column].astype(stored[column].dtype)
+    df = pd.concat([stored, df], ignore_index=True)
+    # the categories of the two frames differ, so restore the categorical dtype after the concat
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+
+    # origin of every row, kept through merge(): 0 for new samples, 1 for stored samples and 2 for the stored samples they are compared to
+    origin = np.zeros(len(df), dtype=np.int8)
+    origin[:len(stored)] = 2 if since is None else np.where((stored["date"] >= since).to_numpy(), 2, 1)
+    df["origin"] = origin
+    # the samples are merged first, so a sample read again (e.g. created at the watermark) is cut into the same pieces as its stored copy
+    if merge is not None:
+        df = merge(df)
+    origin = df.pop("origin").to_numpy()
+    # a new sample (or piece) is dropped if it is stored already, distinct samples read in the same run are all kept
+    keys = sample_keys(df)
+    df = df[(origin > 0) | ~np.isin(keys, keys[origin == 2])].reset_index(drop=True)
+    return write_data_frame(df, outputFileName, year)
+
+
+# Desc: Reads the per type and year watermarks written by the previous incremental runs
+# Input: None
+# Output: Dictionary of (dataTypeString, year) -> timezone aware creation datetime (empty if there was no previous run)
+def read_watermarks():
+    if not os.path.exists(WATERMARK_FILE):
+        return {}
+    with open(WATERMARK_FILE, "r") as file:
+        watermarks = json.load(file)
+    # watermarks written without a year can't be matched to a partition, their types are ingested again (stored samples are dropped)
+    return {
+        (dataTypeString, year): datetime.strptime(value, WATERMARK_FORMAT)
+        for year, yearWatermarks in watermarks.items() if isinstance(yearWatermarks, dict)
+        for dataTypeString, value in yearWatermarks.items()
+    }
+
+
+# Desc: Persists the per type and year watermarks of the incremental ingestion
+# Input: Dictionary of (dataTypeString, year) -> timezone aware creation datetime
+# Output: Watermark json file
+def write_watermarks(watermarks):
+    yearWatermarks = {}
+    for (dataTypeString, year), value in sorted(watermarks.items()):
+        yearWatermarks.setdefault(year, {})[dataTypeString] = value.strftime(WATERMARK_FORMAT)
+    os.makedirs(PARQUET_DIR, exist_ok=True)
+    with open(WATERMARK_FILE, "w") as file:
+        json.dump(yearWatermarks, file, indent=4)
+
+
+# Desc: Reads the typed data for a data type, loading only the requested columns
+# Input: Output file name of the data type, optionally the year (YYYY, all years if None) and the list of columns to load
+# Output: DataFrame
+def read_data_type(outputFileName, year=None, columns=None):
+    if year is not None:
+        return pd.read_parquet(parquet_path(outputFileName, year), columns=columns)
+
+    frames = [pd.read_parquet(partitionFile, columns=columns) for partitionFile in partition_paths(outputFileName)]
+    return pd.concat(frames, ignore_index=True)
+
+
+# Desc: Lists the parquet files of every extracted year of a data type
+# Input: Output file name of the data type
+# Output: List of paths, sorted by year
+def partition_paths(outputFileName):
+    dataTypeDir = os.path.join(PARQUET_DIR, outputFileName)
+    if not os.path.isdir(dataTypeDir):
+        return []
+    return [os.path.join(dataTypeDir, partition, "data.parquet") for partition in sorted(os.listdir(dataTypeDir)) if partition.startswith("year=")]